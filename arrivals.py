@@ -0,0 +1,89 @@
+import os
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+
+def read_table(path):
+    # Read a CSV or Parquet file (the latter needs pyarrow) into a DataFrame
+    if str(path).endswith(".parquet"):
+        return pd.read_parquet(path)
+    return pd.read_csv(path)
+
+
+def file_signature(path):
+    # (path, size, mtime) of a file, which changes whenever the file is edited
+    stat = os.stat(path)
+    return path, stat.st_size, stat.st_mtime_ns
+
+
+def load_arrival_profile(path):
+    """
+    path {str}: CSV or Parquet file with start_secs and walk_ins_per_hour
+        columns. Each row's rate holds from its start (seconds after opening)
+        until the next row's start, with no walk-ins before the first row.
+
+    Returns read-only (starts, walk-ins per second) arrays sorted by start.
+    Profiles are cached per process, since every run of a sweep reads the
+    same one, and reread once the file changes.
+    """
+    return read_arrival_profile(file_signature(path))
+
+
+@lru_cache(maxsize=16)
+def read_arrival_profile(signature):
+    path = signature[0]
+    profile = read_table(path).sort_values("start_secs")
+    starts = profile["start_secs"].to_numpy(dtype=np.float64)
+    rates = profile["walk_ins_per_hour"].to_numpy(dtype=np.float64) / 3600
+    if (rates < 0).any():
+        raise ValueError(f"Arrival profile {path} has negative rates")
+    starts.setflags(write=False)
+    rates.setflags(write=False)
+    return starts, rates
+
+
+def load_appointment_book(path):
+    """
+    path {str}: CSV or Parquet file with a time_secs column holding the time
+        of each appointment in seconds after opening
+
+    Returns the read-only, sorted appointment times, cached like profiles.
+    """
+    return read_appointment_book(file_signature(path))
+
+
+@lru_cache(maxsize=16)
+def read_appointment_book(signature):
+    times = np.sort(read_table(signature[0])["time_secs"].to_numpy(dtype=np.float64))
+    times.setflags(write=False)
+    return times
+
+
+def profile_rate(starts, rates, times):
+    # Walk-in rate of a piecewise constant profile at each of the given times
+    segment = np.searchsorted(starts, times, side="right") - 1
+    return np.where(segment >= 0, rates[np.maximum(segment, 0)], 0.0)
+
+
+def nhpp_arrival_times(generator, starts, rates, duration):
+    """
+    generator {np.random.Generator}: Source of the arrivals' randomness
+    starts {np.ndarray}: Seconds after opening each rate holds from
+    rates {np.ndarray}: Mean walk-ins per second from each start on
+    duration {float}: Seconds the clinic takes walk-ins for
+
+    Returns the sorted walk-in times of one day of a non-homogeneous Poisson
+    process, generated in one vectorized step by thinning.
+    """
+    peak_rate = rates.max(initial=0.0)
+    if peak_rate <= 0:
+        return np.empty(0)
+    # Candidates of a homogeneous process at the peak rate: given how many
+    # there are, their times are sorted uniforms over the day
+    count = generator.poisson(peak_rate * duration)
+    candidates = np.sort(generator.uniform(0, duration, count))
+    # Keep each candidate with probability rate(t) / peak rate
+    keep = generator.random(count) * peak_rate < profile_rate(starts, rates, candidates)
+    return candidates[keep]
@@ -0,0 +1,169 @@
+import argparse
+import json
+import sys
+import time
+import tracemalloc
+from dataclasses import replace
+
+import numpy as np
+from loguru import logger
+
+from main import BASE_SEED, ClinicConfig, run_scenario, run_sweep
+from profiling import CountingEnvironment
+
+
+def benchmark_run(config, repeats=3):
+    # Time one clinic run, keeping the fastest of repeats, then run it once
+    # more under tracemalloc for the peak memory
+    wall_times = []
+    for _ in range(repeats):
+        env = CountingEnvironment()
+        tic = time.perf_counter()
+        clinic = run_scenario(config, env=env)
+        wall_times.append(time.perf_counter() - tic)
+    tracemalloc.start()
+    run_scenario(config)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    wall_time = min(wall_times)
+    return {
+        "wall_time": wall_time,
+        "events": env.events_processed,
+        "events_per_sec": env.events_processed / wall_time,
+        "patients": len(clinic.patient_records),
+        "peak_mb": peak / 2**20,
+    }
+
+
+def benchmark_sweep(config, scenarios, worker_counts, replications=1):
+    # Wall time of the same sweep at each worker count
+    results = {}
+    for workers in worker_counts:
+        tic = time.perf_counter()
+        rows = list(run_sweep(config, scenarios, BASE_SEED, replications, workers))
+        results[f"sweep-{workers}w"] = {
+            "wall_time": time.perf_counter() - tic,
+            "runs": len(rows),
+        }
+    return results
+
+
+def run_cases(quick=False):
+    # Benchmark single runs across arrival rate, simulated hours and staffing,
+    # then full sweeps across worker counts
+    repeats = 1 if quick else REPEATS
+    results = {}
+    for high_flow_rate in FLOW_RATES[:2] if quick else FLOW_RATES:
+        config = replace(
+            BASE_CONFIG, high_flow_rate=high_flow_rate, low_flow_rate=2 * high_flow_rate
+        )
+        results[f"flow-{high_flow_rate}"] = benchmark_run(config, repeats)
+    for sim_hrs in SIM_HOURS[:2] if quick else SIM_HOURS:
+        config = replace(BASE_CONFIG, sim_hrs=sim_hrs)
+        results[f"hours-{sim_hrs}"] = benchmark_run(config, repeats)
+    for num_receptionists, num_nurses in STAFFING:
+        config = replace(
+            BASE_CONFIG, num_receptionists=num_receptionists, num_nurses=num_nurses
+        )
+        results[f"staff-{num_receptionists}R-{num_nurses}N"] = benchmark_run(
+            config, repeats
+        )
+    if not quick:
+        results.update(benchmark_sweep(BASE_CONFIG, SWEEP_SCENARIOS, WORKER_COUNTS))
+    return results
+
+
+def scaling_exponent(results, prefix):
+    # Slope of log wall time against log patients over a family of cases.
+    # About 1 means run time grows linearly with patients, clearly above 1
+    # means something in the hot path has become superlinear.
+    cases = [result for name, result in results.items() if name.startswith(prefix)]
+    if len(cases) < 2:
+        return None
+    patients = np.log([case["patients"] for case in cases])
+    wall_times = np.log([case["wall_time"] for case in cases])
+    return float(np.polyfit(patients, wall_times, 1)[0])
+
+
+def compare(results, baseline, tolerance):
+    # List the cases that got slower than the baseline by more than tolerance
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        ratio = result["wall_time"] / baseline[name]["wall_time"]
+        logger.info(f"{name}: {ratio:.2f}x baseline wall time")
+        if ratio > 1 + tolerance:
+            regressions.append(f"{name} is {ratio:.2f}x slower than the baseline")
+    return regressions
+
+
+def log_results(results):
+    for name, result in results.items():
+        if "events" in result:
+            logger.info(
+                f"{name}: {result['wall_time']:.3f} s, {result['events']} events, "
+                + f"{result['events_per_sec']:.0f} events/s, "
+                + f"{result['patients']} patients, {result['peak_mb']:.1f} MB peak"
+            )
+        else:
+            logger.info(
+                f"{name}: {result['wall_time']:.3f} s for {result['runs']} runs"
+            )
+
+
+BASE_CONFIG = ClinicConfig(num_receptionists=2, num_nurses=5, seed=BASE_SEED)
+REPEATS = 5  # Runs per case, the fastest one counts
+FLOW_RATES = [1.0, 0.5, 0.25, 0.125]  # High flow rates, low flow rate is double
+SIM_HOURS = [3, 6, 12, 24]
+STAFFING = [(1, 1), (2, 5), (5, 10), (10, 10)]
+SWEEP_SCENARIOS = [[i, j] for i in range(1, 5) for j in range(1, 5)]
+WORKER_COUNTS = [1, 2, 4]
+BASELINE_FILE = "benchmark_baseline.json"
+REGRESSION_TOLERANCE = 0.25  # Fail when a case is 25% slower than its baseline
+MAX_SCALING_EXPONENT = 1.2  # Fail when wall time grows faster than patients^1.2
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark VaccineClinic runs")
+    parser.add_argument(
+        "--save-baseline", action="store_true", help=f"write {BASELINE_FILE}"
+    )
+    parser.add_argument(
+        "--no-baseline",
+        action="store_true",
+        help="only check scaling, without comparing to a baseline",
+    )
+    parser.add_argument(
+        "--quick", action="store_true", help="fewer cases, one repeat, no sweeps"
+    )
+    args = parser.parse_args()
+    logger.remove()
+    logger.add(sys.stderr, format="{message}", level="INFO")
+
+    results = run_cases(args.quick)
+    log_results(results)
+    failures = []
+    for prefix in ("flow-", "hours-"):
+        exponent = scaling_exponent(results, prefix)
+        logger.info(f"{prefix[:-1]} scaling exponent: {exponent:.2f}")
+        if exponent > MAX_SCALING_EXPONENT:
+            failures.append(f"{prefix[:-1]} cases scale as patients^{exponent:.2f}")
+    if args.save_baseline:
+        with open(BASELINE_FILE, "w") as baseline_file:
+            json.dump(results, baseline_file, indent=2)
+        logger.info(f"Saved baseline to {BASELINE_FILE}")
+    elif not args.no_baseline:
+        # Baselines are machine specific, so each machine saves its own. A
+        # missing one fails the gate rather than passing it unchecked.
+        try:
+            with open(BASELINE_FILE) as baseline_file:
+                baseline = json.load(baseline_file)
+        except FileNotFoundError:
+            failures.append(
+                f"No {BASELINE_FILE}: run with --save-baseline on this machine "
+                + "first, or --no-baseline to skip the comparison"
+            )
+        else:
+            failures += compare(results, baseline, REGRESSION_TOLERANCE)
+    for failure in failures:
+        logger.error(failure)
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,168 @@
+import hashlib
+import json
+import os
+import sqlite3
+from dataclasses import asdict
+
+# Config fields that don't change a run's summary row, so aren't part of the key
+UNKEYED_FIELDS = ("trace", "output_dir", "profile", "queue_traces")
+# Config fields naming input files, keyed by their contents as well as name
+FILE_FIELDS = ("arrival_profile", "appointment_book")
+
+
+def file_digest(path):
+    # SHA-256 of a file's contents, so editing an input file invalidates the
+    # runs that read it
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1 << 16), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class ResultCache(object):
+    # Persistent cache of run summary rows in a SQLite file. A row is keyed
+    # by a hash of the model version, the run's full config (seed included)
+    # and its replication number. Once the stored rows pass max_bytes, the
+    # least recently used ones are evicted.
+    def __init__(self, path, model_version, max_bytes=64 << 20):
+        """
+        path {str}: SQLite file to keep the cache in, created if missing
+        model_version {str}: Version of the model, part of every key so rows
+            from an older model are never returned
+        max_bytes {int}: Size the stored rows are kept under
+        """
+        self.model_version = str(model_version)
+        self.max_bytes = max_bytes
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "key TEXT PRIMARY KEY, row TEXT NOT NULL, "
+            "size INTEGER NOT NULL, last_used INTEGER NOT NULL)"
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)"
+        )
+        self.total_bytes, self.clock = self.connection.execute(
+            "SELECT COALESCE(SUM(size), 0), COALESCE(MAX(last_used), 0) FROM results"
+        ).fetchone()
+        self.file_digests = {}
+        self.hits = 0
+        self.misses = 0
+        # The cache may have been left bigger than a lower max_bytes allows
+        if self.total_bytes > self.max_bytes:
+            self.evict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    @staticmethod
+    def cacheable(task):
+        # Runs that write Parquet output, are traced or are profiled are run
+        # for their side effects, so they always run and are never stored
+        config, _ = task
+        return config.output_dir is None and not config.trace and not config.profile
+
+    def digest(self, path):
+        # Digest of an input file, reused while its size and mtime are unchanged
+        stat = os.stat(path)
+        signature = (path, stat.st_size, stat.st_mtime_ns)
+        if signature not in self.file_digests:
+            self.file_digests[signature] = file_digest(path)
+        return self.file_digests[signature]
+
+    def key(self, task):
+        # Hash of everything a (config, replication) task's row depends on
+        config, replication = task
+        fields = asdict(config)
+        for name in UNKEYED_FIELDS:
+            fields.pop(name)
+        for name in FILE_FIELDS:
+            if fields[name] is not None:
+                fields[name] = [fields[name], self.digest(fields[name])]
+        payload = json.dumps(
+            [self.model_version, fields, replication], sort_keys=True, default=str
+        )
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def tick(self):
+        self.clock += 1
+        return self.clock
+
+    def get_many(self, tasks):
+        """
+        tasks {list}: (config, replication) tasks to look up
+
+        Returns {task index: row} for the tasks with a stored row, and marks
+        those rows as recently used.
+        """
+        keys = {
+            index: self.key(task)
+            for index, task in enumerate(tasks)
+            if self.cacheable(task)
+        }
+        found = {}
+        unique_keys = list(set(keys.values()))
+        # Look the keys up in chunks to stay under SQLite's variable limit
+        for start in range(0, len(unique_keys), 500):
+            chunk = unique_keys[start : start + 500]
+            found.update(
+                self.connection.execute(
+                    f"SELECT key, row FROM results WHERE key IN "
+                    f"({', '.join('?' * len(chunk))})",
+                    chunk,
+                ).fetchall()
+            )
+        with self.connection:
+            self.connection.executemany(
+                "UPDATE results SET last_used = ? WHERE key = ?",
+                [(self.tick(), key) for key in found],
+            )
+        rows = {
+            index: json.loads(found[key])
+            for index, key in keys.items()
+            if key in found
+        }
+        self.hits += len(rows)
+        self.misses += len(tasks) - len(rows)
+        return rows
+
+    def put(self, task, row):
+        # Store the row of a finished task, then evict down to max_bytes
+        if not self.cacheable(task):
+            return
+        key = self.key(task)
+        data = json.dumps(row, default=lambda value: value.item())
+        with self.connection:
+            old = self.connection.execute(
+                "SELECT size FROM results WHERE key = ?", (key,)
+            ).fetchone()
+            self.connection.execute(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)",
+                (key, data, len(data), self.tick()),
+            )
+        self.total_bytes += len(data) - (old[0] if old else 0)
+        if self.total_bytes > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        # Drop the least recently used rows until the rest fit in max_bytes
+        with self.connection:
+            for key, size in self.connection.execute(
+                "SELECT key, size FROM results ORDER BY last_used"
+            ).fetchall():
+                if self.total_bytes <= self.max_bytes:
+                    break
+                self.connection.execute("DELETE FROM results WHERE key = ?", (key,))
+                self.total_bytes -= size
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM results").fetchone()[0]
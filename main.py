@@ -8,392 +8,1105 @@ import simpy
 from loguru import logger
 from icecream import ic
 import time
+import copy
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from collections import Counter, OrderedDict
+from enum import IntEnum
+from dataclasses import dataclass, replace
+from functools import partial
+from statistics import NormalDist
+import math
+import os
+from arrivals import load_appointment_book, load_arrival_profile, nhpp_arrival_times
+from cache import ResultCache
+from online_stats import SampleStats, TimeWeightedStats
+from profiling import RunProfiler, write_collapsed_stacks
+from queueing import screen_scenarios
+
+# Parquet output is optional, the model runs without pyarrow installed
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+
+class ColumnStore(object):
+    # Append-only record store that keeps each column in its own NumPy array.
+    # The arrays double in size when full so appending a row is amortized O(1)
+    # instead of copying a whole DataFrame on every pd.concat.
+    # If a sink is given, the store never grows: each time it fills up its rows
+    # are handed to sink(columns) and it starts over, so memory stays at
+    # capacity rows.
+    def __init__(self, columns, capacity=1024, sink=None):
+        # Map of column name to NumPy dtype, kept in column order
+        self.dtypes = dict(columns)
+        self.capacity = capacity
+        self.size = 0
+        self.sink = sink
+        self.flushed = 0
+        self.columns = {
+            name: np.empty(capacity, dtype=dtype) for name, dtype in self.dtypes.items()
+        }
+
+    def __len__(self):
+        return self.size
+
+    def grow(self):
+        # Double the capacity of every column and copy the filled rows over
+        self.capacity *= 2
+        for name, column in self.columns.items():
+            grown = np.empty(self.capacity, dtype=self.dtypes[name])
+            grown[: self.size] = column[: self.size]
+            self.columns[name] = grown
+
+    def append(self, **row):
+        # Add a full row and return the slot it was written to
+        if self.size == self.capacity:
+            if self.sink is not None:
+                self.flush()
+            else:
+                self.grow()
+        for name, column in self.columns.items():
+            column[self.size] = row[name]
+        self.size += 1
+        return self.size - 1
+
+    def set(self, name, slot, value):
+        self.columns[name][slot] = value
+
+    def flush(self):
+        # Hand the filled rows to the sink and empty the store
+        if self.size:
+            self.sink(
+                {name: column[: self.size] for name, column in self.columns.items()}
+            )
+            self.flushed += self.size
+            self.size = 0
+
+    def to_dataframe(self):
+        # Build a DataFrame from the filled part of every column
+        return pd.DataFrame(
+            {name: column[: self.size] for name, column in self.columns.items()},
+            columns=list(self.columns),
+        )
+
+
+class ParquetOutput(object):
+    # Streams the record tables of one run into Parquet datasets under root,
+    # one dataset per table, hive-partitioned by scenario, replication and seed:
+    # root/event_log/receptionists=2/nurses=5/replication=0/seed=123/part-0.parquet
+    # Every write becomes its own row group, so tables can be written in
+    # pieces while the simulation runs.
+    def __init__(self, root, partition, row_group_size=65536):
+        if pq is None:
+            raise ImportError("Parquet output needs pyarrow: pip install pyarrow")
+        self.root = root
+        self.partition_path = os.path.join(
+            *(f"{key}={value}" for key, value in partition.items())
+        )
+        self.row_group_size = row_group_size
+        self.writers = {}
+
+    def write(self, table, columns):
+        # Write a dict of column arrays as one row group of the table. Object
+        # columns (mixed int and "A_n" patient ids, actions) are stored as text.
+        arrays = {}
+        for name, column in columns.items():
+            column = np.asarray(column)
+            arrays[name] = column.astype(str) if column.dtype == object else column
+        batch = pa.table(arrays)
+        writer = self.writers.get(table)
+        if writer is None:
+            directory = os.path.join(self.root, table, self.partition_path)
+            os.makedirs(directory, exist_ok=True)
+            writer = pq.ParquetWriter(
+                os.path.join(directory, "part-0.parquet"), batch.schema
+            )
+            self.writers[table] = writer
+        writer.write_table(batch)
+
+    def close(self):
+        for writer in self.writers.values():
+            writer.close()
+        self.writers = {}
+
+
+@dataclass(frozen=True)
+class ClinicConfig(object):
+    # Every parameter of one clinic run. The config is frozen so it can be
+    # shared between runs, hashed, and sent to worker processes safely.
+    num_receptionists: int = 1
+    num_nurses: int = 1
+    rushed_pct: float = 25  # Set percent of rushed patients
+    mean_vaccine_time: float = 3
+    mean_check_in_time: float = 1
+    high_flow_rate: float = 0.25
+    low_flow_rate: float = 0.5
+    appointment_freq: float = 15 * 60  # Appts every 15 mins
+    sim_hrs: float = 12
+    # CSV/Parquet walk-in profile to draw walk-ins from instead of the flow
+    # rates, and appointment book to use instead of appointment_freq
+    arrival_profile: str = None
+    appointment_book: str = None
+    queue_traces: bool = False  # Keep every [time, length] queue length sample
+    seed: int = None  # Seed of the run's random streams, None for fresh entropy
+    trace: bool = False  # Log every patient event at TRACE level
+    output_dir: str = None  # Stream run records to Parquet datasets here
+    profile: bool = False  # Time the clinic's hot methods and sample stacks
+
+    @property
+    def sim_secs(self):
+        return self.sim_hrs * 60 * 60
+
+
+class VariateStream(object):
+    # Independent stream of standard normal or uniform variates. Variates are
+    # drawn from the stream's own Generator in large vectorized batches and
+    # handed out one at a time, so a variate costs a list index instead of a
+    # NumPy call.
+    def __init__(self, seed_seq, kind="normal", batch_size=4096):
+        self.generator = np.random.default_rng(seed_seq)
+        self.kind = kind
+        self.batch_size = batch_size
+        self.buffer = []
+        self.position = 0
+
+    def refill(self):
+        # Draw the next batch of variates as Python floats
+        if self.kind == "normal":
+            batch = self.generator.standard_normal(self.batch_size)
+        else:
+            batch = self.generator.random(self.batch_size)
+        self.buffer = batch.tolist()
+        self.position = 0
+
+    def next(self):
+        if self.position == len(self.buffer):
+            self.refill()
+        value = self.buffer[self.position]
+        self.position += 1
+        return value
+
+    def normal(self, mean, sd):
+        # Scale the next standard normal to the given mean and SD
+        return mean + sd * self.next()
+
+
+class MonitoredResourceMixin(object):
+    # Keeps exact time-weighted totals of a SimPy resource's busy servers, idle
+    # servers and queue length. SimPy changes the users and queue of a resource
+    # only inside _trigger_put and _trigger_get, so the totals are brought up
+    # to date before each of those and the new state is recorded after, which
+    # takes O(1) time and memory per request or release.
+    STAT_ATTRIBUTES = (
+        "start_time",
+        "last_update",
+        "last_count",
+        "last_queue_length",
+        "busy_time",
+        "idle_time",
+        "queue_time",
+        "max_queue_length",
+        "grants",
+        "releases",
+    )
+
+    def __init__(self, env, capacity=1):
+        self.start_time = env.now
+        self.last_update = env.now
+        self.last_count = 0
+        self.last_queue_length = 0
+        self.busy_time = 0.0
+        self.idle_time = 0.0
+        self.queue_time = 0.0
+        self.max_queue_length = 0
+        self.grants = 0
+        self.releases = 0
+        super().__init__(env, capacity)
+
+    def update(self, until=None):
+        # Add the time since the last change (up to now unless until is
+        # given), weighted by the state that held over it
+        until = self._env.now if until is None else until
+        elapsed = until - self.last_update
+        if elapsed > 0:
+            self.busy_time += self.last_count * elapsed
+            self.idle_time += max(self.capacity - self.last_count, 0) * elapsed
+            self.queue_time += self.last_queue_length * elapsed
+            self.last_update = until
+
+    def record_state(self):
+        self.last_count = len(self.users)
+        self.last_queue_length = len(self.put_queue)
+        self.max_queue_length = max(self.max_queue_length, self.last_queue_length)
+
+    def _trigger_put(self, get_event):
+        self.update()
+        count = len(self.users)
+        super()._trigger_put(get_event)
+        self.grants += len(self.users) - count
+        self.record_state()
+
+    def _trigger_get(self, put_event):
+        self.update()
+        count = len(self.users)
+        super()._trigger_get(put_event)
+        self.releases += count - len(self.users)
+        self.record_state()
+
+    def set_capacity(self, capacity):
+        # Change the number of servers, e.g. when staff move between clinics.
+        # Servers taken away while busy finish their request first. Requests
+        # waiting for a server are granted right away if servers were added.
+        self.update()
+        self._capacity = capacity
+        self._trigger_put(None)
+
+    def stats(self):
+        # Copy of the running totals, e.g. for a clinic snapshot
+        return {name: getattr(self, name) for name in self.STAT_ATTRIBUTES}
+
+    def restore_stats(self, stats):
+        for name, value in stats.items():
+            setattr(self, name, value)
+        self.record_state()
+
+    def utilization(self):
+        # Fraction of server time spent busy so far
+        total = self.busy_time + self.idle_time
+        return self.busy_time / total if total else 0.0
+
+    def mean_queue_length(self):
+        # Time-weighted mean number of requests waiting so far
+        elapsed = self.last_update - self.start_time
+        return self.queue_time / elapsed if elapsed else 0.0
+
+    def summary(self):
+        return {
+            "Capacity": self.capacity,
+            "Busy Time": self.busy_time,
+            "Free Time": self.idle_time,
+            "Utilization": self.utilization(),
+            "Mean Queue Length": self.mean_queue_length(),
+            "Max Queue Length": self.max_queue_length,
+            "Grants": self.grants,
+            "Releases": self.releases,
+        }
+
+
+class MonitoredResource(MonitoredResourceMixin, simpy.Resource):
+    pass
+
+
+class MonitoredPriorityResource(MonitoredResourceMixin, simpy.PriorityResource):
+    pass
+
+
+class PatientType(IntEnum):
+    RELAXED = 0
+    RUSHED = 1
+    SCHEDULED = 2
+
+
+class Outcome(IntEnum):
+    # How a patient left the clinic, NONE while they are still inside
+    NONE = 0
+    BALKED = 1
+    RENEGED = 2
+    VACCINATED = 3
+
+
+class EventAction(IntEnum):
+    JOIN_CHECK_IN = 0
+    BALK = 1
+    RENEGED_CHECK_IN = 2
+    SWITCH_TO_VACCINATION = 3
+    RENEGED_VACCINATION = 4
+    VACCINATED = 5
+
+
+# Labels the integer codes are turned back into for the output DataFrames
+PATIENT_TYPE_LABELS = np.array(["relaxed", "rushed", "Scheduled"], dtype=object)
+OUTCOME_LABELS = np.array([0, "Balked", "Reneged", "Vaccinated"], dtype=object)
+EVENT_ACTION_LABELS = np.array(
+    [
+        "Join Check-in Queue",
+        "balk",
+        "Reneged From Check-In Queue",
+        "Switch to Vaccination Queue",
+        "Reneged From Vaccination Queue",
+        "Vaccinated",
+    ],
+    dtype=object,
+)
+
+
+def patient_id_labels(numbers, scheduled):
+    # Walk-ins are labelled by their number and appointments as "A_n"
+    labels = numbers.astype(object)
+    labels[scheduled] = [f"A_{number}" for number in numbers[scheduled]]
+    return labels
+
+
+class Patient(object):
+    # Compact state of one patient while they are in the clinic. Walk-ins and
+    # appointments are numbered separately, so a patient is identified by
+    # their number and the scheduled flag. slot is their row in the clinic's
+    # patient records.
+    __slots__ = (
+        "number",
+        "scheduled",
+        "patient_type",
+        "balk_max",
+        "renege_max",
+        "check_in_time",
+        "queued_at",
+        "service_end",
+        "slot",
+    )
+
+    def __init__(
+        self, number, scheduled, patient_type, balk_max, renege_max, check_in_time
+    ):
+        self.number = number
+        self.scheduled = scheduled
+        self.patient_type = patient_type
+        self.balk_max = balk_max
+        self.renege_max = renege_max
+        self.check_in_time = check_in_time
+        # Time the patient joined the queue they're in
+        self.queued_at = check_in_time
+        # Time the patient's current service ends, None while they wait
+        self.service_end = None
+        self.slot = None
+
+    @property
+    def label(self):
+        return f"A_{self.number}" if self.scheduled else self.number
+
+
+@dataclass(frozen=True)
+class ClinicSnapshot(object):
+    # State of a clinic part way through a run: the time it was taken, the
+    # config the clinic ran with, and copies of its queues, patients, random
+    # streams, records and resource totals. It can be pickled and sent to
+    # worker processes, and restored any number of times.
+    time: float
+    config: ClinicConfig
+    state: dict
 
 
 class VaccineClinic(object):
-    # Initialize the clinic with the environment and number of employees
-    def __init__(self, env, num_receptionists, num_nurses):
+    # Attributes a snapshot copies. The patients in the queues are copied
+    # along with them, including when a patient's current service ends.
+    SNAPSHOT_ATTRIBUTES = (
+        "arrival_stream",
+        "patient_type_stream",
+        "check_in_stream",
+        "vaccination_stream",
+        "check_in_queue",
+        "vaccination_queue",
+        "num_walk_ins",
+        "num_appointments",
+        "num_balked",
+        "num_reneged",
+        "num_vaccinated",
+        "patient_records",
+        "event_records",
+        "vaccination_queue_length",
+        "check_in_queue_length",
+        "check_in_queue_stats",
+        "vaccination_queue_stats",
+        "check_in_wait",
+        "vaccination_wait",
+        "time_in_system",
+        "opened_at",
+        "last_departure",
+        "next_walk_in",
+        "next_appointment",
+        "walk_in_times",
+        "walk_in_index",
+        "appointment_times",
+        "appointment_index",
+    )
+
+    # Initialize the clinic with the environment and its config, and
+    # optionally a ParquetOutput to stream the run's records to
+    def __init__(self, env, config, output=None):
         self.env = env
-        self.num_receptionists = num_receptionists
-        self.num_nurses = num_nurses
-        # Set a receptionist as a priority resource
-        self.receptionist = simpy.PriorityResource(env, num_receptionists)
-        # Set a nurse as a resource
-        self.nurse = simpy.Resource(env, num_nurses)
-        # Set the queues
-        self.check_in_queue = []
-        self.vaccination_queue = []
-        # Start a list of balkers and renegers
-        self.balkers = []
-        self.renegers = []
-        self.vaccinated = []
-        # Initialize a DataFrame for full patient info
-        self.patient_info_df = pd.DataFrame(
-            columns=[
-                "patient_id",
-                "patient_type",
-                "balk_max",
-                "renege_max",
-                "check_in_time",
-                "leave_time",
-                "action",
+        self.config = config
+        self.output = output
+        self.num_receptionists = config.num_receptionists
+        self.num_nurses = config.num_nurses
+        # Only build per-patient trace messages when trace logging is on
+        self.trace = config.trace
+        # Give each source of randomness its own stream so one can change
+        # without shifting the others
+        seed_seqs = np.random.SeedSequence(config.seed).spawn(4)
+        self.arrival_stream = VariateStream(seed_seqs[0])
+        self.patient_type_stream = VariateStream(seed_seqs[1], kind="uniform")
+        self.check_in_stream = VariateStream(seed_seqs[2])
+        self.vaccination_stream = VariateStream(seed_seqs[3])
+        # Set a receptionist as a priority resource that tracks its own
+        # busy and idle time
+        self.receptionist = MonitoredPriorityResource(env, config.num_receptionists)
+        # Set a nurse as a monitored resource
+        self.nurse = MonitoredResource(env, config.num_nurses)
+        # Set the queues as ordered dicts of patients so patients can join
+        # either end and leave from anywhere in O(1)
+        self.check_in_queue = OrderedDict()
+        self.vaccination_queue = OrderedDict()
+        # Count the walk-ins, appointments, balkers, renegers and vaccinated
+        # patients
+        self.num_walk_ins = 0
+        self.num_appointments = 0
+        self.num_balked = 0
+        self.num_reneged = 0
+        self.num_vaccinated = 0
+        # Initialize a columnar store for full patient info, with the patient
+        # type and outcome stored as small integer codes
+        self.patient_records = ColumnStore(
+            {
+                "patient_number": np.int64,
+                "scheduled": np.bool_,
+                "patient_type": np.int8,
+                "balk_max": np.int64,
+                "renege_max": np.float64,
+                "check_in_time": np.float64,
+                "leave_time": np.float64,
+                "action": np.int8,
+            }
+        )
+        # Initialize a columnar store for events in the clinic. With Parquet
+        # output the events are written out one row group at a time instead
+        # of being kept in memory.
+        event_columns = {
+            "patient_number": np.int64,
+            "scheduled": np.bool_,
+            "action": np.int8,
+            "time": np.float64,
+        }
+        if output is None:
+            self.event_records = ColumnStore(event_columns)
+        else:
+            self.event_records = ColumnStore(
+                event_columns,
+                capacity=output.row_group_size,
+                sink=partial(output.write, "event_log"),
+            )
+        # The DataFrames are only built once the run has finished
+        self.patient_info_df = None
+        self.event_log_df = None
+        # Keep running statistics of the queue lengths, waits for a
+        # receptionist or nurse, and vaccinated patients' time in the clinic
+        self.check_in_queue_stats = TimeWeightedStats(env.now)
+        self.vaccination_queue_stats = TimeWeightedStats(env.now)
+        self.check_in_wait = SampleStats()
+        self.vaccination_wait = SampleStats()
+        self.time_in_system = SampleStats()
+        # Only keep lists of queue lengths throughout the simulation if asked
+        if config.queue_traces:
+            self.vaccination_queue_length = []
+            self.check_in_queue_length = []
+        else:
+            self.vaccination_queue_length = None
+            self.check_in_queue_length = None
+        # Time the clinic opened, which the flow schedule and closing time
+        # are relative to, and the time the last patient left
+        self.opened_at = env.now
+        self.last_departure = 0
+        # Times the next walk-in and appointment arrive, None once closed
+        self.next_walk_in = None
+        self.next_appointment = None
+        # With an arrival profile, the whole day's walk-in times are drawn up
+        # front and replayed, and likewise the times of an appointment book
+        self.walk_in_times = None
+        self.walk_in_index = 0
+        if config.arrival_profile is not None:
+            starts, rates = load_arrival_profile(config.arrival_profile)
+            self.walk_in_times = nhpp_arrival_times(
+                self.arrival_stream.generator, starts, rates, config.sim_secs
+            ).tolist()
+        self.appointment_times = None
+        self.appointment_index = 0
+        if config.appointment_book is not None:
+            self.appointment_times = load_appointment_book(
+                config.appointment_book
+            ).tolist()
+        # Called with each patient who leaves unvaccinated, e.g. by a clinic
+        # network that sends them back another day
+        self.on_leave = None
+
+    def snapshot(self):
+        # Copy the clinic's state between env.run calls, e.g. after
+        # env.run(until=time). The copy is independent of the running clinic,
+        # which can carry on.
+        if self.output is not None or self.on_leave is not None:
+            raise ValueError(
+                "Only clinics without Parquet output or a network can be snapshotted"
+            )
+        self.receptionist.update()
+        self.nurse.update()
+        state = {name: getattr(self, name) for name in self.SNAPSHOT_ATTRIBUTES}
+        state["receptionist"] = self.receptionist.stats()
+        state["nurse"] = self.nurse.stats()
+        return ClinicSnapshot(self.env.now, self.config, copy.deepcopy(state))
+
+    @classmethod
+    def from_snapshot(cls, env, snapshot, config=None):
+        """
+        env {simpy.Environment}: Fresh environment starting at the snapshot time
+        snapshot {ClinicSnapshot}: State to carry on from
+        config {ClinicConfig}: Config to carry on with, e.g. with more nurses,
+            None for the snapshot's config. Changes apply from the snapshot
+            time on, waits and service times already drawn are kept.
+
+        Returns the restored clinic with its processes started.
+        """
+        if env.now != snapshot.time:
+            raise ValueError(
+                f"Environment starts at {env.now}, the snapshot at {snapshot.time}"
+            )
+        clinic = cls(env, snapshot.config if config is None else config)
+        # Copy the state again so the snapshot can be restored more than once
+        state = copy.deepcopy(snapshot.state)
+        resource_stats = {
+            "receptionist": state.pop("receptionist"),
+            "nurse": state.pop("nurse"),
+        }
+        for name, value in state.items():
+            setattr(clinic, name, value)
+        # Hand the patients who were being served their server back straight
+        # away, then line the waiting patients up in the order they were
+        # queued. Staff taken away finish their patient first.
+        for name, queue, resume in (
+            ("receptionist", clinic.check_in_queue, clinic.resume_check_in),
+            ("nurse", clinic.vaccination_queue, clinic.resume_vaccination),
+        ):
+            resource = getattr(clinic, name)
+            capacity = resource.capacity
+            in_service = [
+                patient for patient in queue if patient.service_end is not None
             ]
+            resource.set_capacity(max(capacity, len(in_service)))
+            for patient in in_service:
+                if name == "receptionist":
+                    req = resource.request(priority=-1 if patient.scheduled else 0)
+                else:
+                    req = resource.request()
+                env.process(resume(patient, req))
+            # The totals are restored after the requests above, so those
+            # aren't counted as new grants
+            resource.restore_stats(resource_stats[name])
+            resource.set_capacity(capacity)
+        waiting = [
+            patient
+            for patient in clinic.check_in_queue
+            if patient.service_end is None
+        ]
+        # Scheduled patients go first, then everyone in the order they came
+        waiting.sort(key=lambda patient: (not patient.scheduled, patient.check_in_time))
+        for patient in waiting:
+            priority = -1 if patient.scheduled else 0
+            env.process(clinic.check_in(patient, patient_priority=priority))
+        for patient in clinic.vaccination_queue:
+            if patient.service_end is None:
+                env.process(clinic.vaccinate(patient))
+        # Carry on with the arrivals that were already on their way
+        if clinic.next_appointment is not None:
+            env.process(clinic.scheduled_arrivals(clinic.next_appointment - env.now))
+        if clinic.next_walk_in is not None:
+            env.process(clinic.arrive(clinic.next_walk_in - env.now))
+        return clinic
+
+    def finalize_records(self):
+        # Close the resource totals when the last patient left. Patience
+        # timeouts of patients who were served still fire after that and
+        # would otherwise count as idle time.
+        self.receptionist.update(self.last_departure)
+        self.nurse.update(self.last_departure)
+        self.check_in_queue_stats.close(self.last_departure)
+        self.vaccination_queue_stats.close(self.last_departure)
+        # Convert the record stores into DataFrames once the run is over,
+        # turning the integer codes back into the patient ids and labels
+        patient_info_df = self.patient_records.to_dataframe()
+        patient_info_df.insert(
+            0,
+            "patient_id",
+            patient_id_labels(
+                patient_info_df.pop("patient_number").to_numpy(),
+                patient_info_df.pop("scheduled").to_numpy(),
+            ),
         )
-        # Initialize a DataFrame for events in the clinic
-        self.event_log_df = pd.DataFrame(columns=["patient_id", "action", "time"])
-        # Start a list of queue lengths throughout the simulation
-        self.vaccination_queue_length = []
-        self.check_in_queue_length = []
-        # Start lists of inactive employees
-        self.nurse_wasted_time = []
-        self.receptionist_wasted_time = []
-
-    def log_wasted_resource_time(self, resource, time1, time2):
-        # Log the amount of time nurses and receptionists are not
-        # Interacting with a patient
-        if resource == self.nurse:
-            self.nurse_wasted_time.append(
-                (resource.capacity - resource.count) * (time2 - time1)
+        patient_info_df["patient_type"] = PATIENT_TYPE_LABELS[
+            patient_info_df["patient_type"].to_numpy()
+        ]
+        patient_info_df["action"] = OUTCOME_LABELS[patient_info_df["action"].to_numpy()]
+        self.patient_info_df = patient_info_df
+        if self.output is None:
+            events = self.event_records.columns
+            size = len(self.event_records)
+            self.event_log_df = pd.DataFrame(
+                {
+                    "patient_id": patient_id_labels(
+                        events["patient_number"][:size], events["scheduled"][:size]
+                    ),
+                    "action": EVENT_ACTION_LABELS[events["action"][:size]],
+                    "time": events["time"][:size],
+                }
             )
         else:
-            self.receptionist_wasted_time.append(
-                (resource.capacity - resource.count) * (time2 - time1)
+            # The event log went to disk as the run went, so it is left as None
+            self.write_output()
+
+    def write_output(self):
+        # Write the rest of the run's records to the Parquet output
+        self.event_records.flush()
+        self.output.write(
+            "patient_info",
+            {
+                name: column[: len(self.patient_records)]
+                for name, column in self.patient_records.columns.items()
+            },
+        )
+        if self.config.queue_traces:
+            self.output.write(
+                "check_in_queue_length",
+                {
+                    "time": [time for time, _ in self.check_in_queue_length],
+                    "check_in_queue_length": [
+                        length for _, length in self.check_in_queue_length
+                    ],
+                },
+            )
+            self.output.write(
+                "vaccination_queue_length",
+                {
+                    "time": [time for time, _ in self.vaccination_queue_length],
+                    "vaccination_queue_length": [
+                        length for _, length in self.vaccination_queue_length
+                    ],
+                },
             )
+        self.output.write(
+            "queue_statistics",
+            {name: [value] for name, value in self.statistics_summary().items()},
+        )
+        resources = [
+            {"Resource": "Receptionist", **self.receptionist.summary()},
+            {"Resource": "Nurse", **self.nurse.summary()},
+        ]
+        self.output.write(
+            "resource_utilization",
+            {name: [row[name] for row in resources] for name in resources[0]},
+        )
+        self.output.close()
+
+    def statistics_summary(self):
+        # Running statistics of the queues, waits and time in the clinic
+        row = {}
+        row.update(self.check_in_queue_stats.summary("Check-In Queue"))
+        row.update(self.vaccination_queue_stats.summary("Vaccination Queue"))
+        row.update(self.check_in_wait.summary("Check-In Wait"))
+        row.update(self.vaccination_wait.summary("Vaccination Wait"))
+        row.update(self.time_in_system.summary("Time In System"))
+        return row
+
+    def add_patient(self, patient):
+        # Add the patient to the patient records and remember their slot
+        patient.slot = self.patient_records.append(
+            patient_number=patient.number,
+            scheduled=patient.scheduled,
+            patient_type=patient.patient_type,
+            balk_max=patient.balk_max,
+            renege_max=patient.renege_max,
+            check_in_time=patient.check_in_time,
+            leave_time=0,
+            action=Outcome.NONE,
+        )
+        return patient
+
+    def set_patient_outcome(self, patient, outcome, leave_time):
+        # Record how and when a patient left the clinic
+        self.last_departure = max(self.last_departure, leave_time)
+        self.patient_records.set("action", patient.slot, outcome)
+        self.patient_records.set("leave_time", patient.slot, leave_time)
+        if outcome == Outcome.VACCINATED:
+            self.time_in_system.add(leave_time - patient.check_in_time)
+        if self.on_leave is not None and outcome != Outcome.VACCINATED:
+            self.on_leave(patient)
 
-    def check_in(self, patient_id, patient_priority, time):
+    def check_in(self, patient, patient_priority):
         # Create a normal distribution with a mean of 1 and a SD of 0.5
         # and return the absolute value of that as the check in time.
-        time2 = self.env.now
-        self.log_wasted_resource_time(self.receptionist, time, time2)
         # If a receptionist is available, start them off with a check-in
         # patient. Otherwise, wait for a receptionist to be available.
         # A scheduled patient will get priority and be put at the front of the line
         with self.receptionist.request(priority=patient_priority) as req:
-            yield req
-            # Set a random amount of time taken to check in with the
-            # receptionist with a SD of 1 and a mean set in the program settings
-            check_in_line_time = (
-                np.abs(np.random.normal(MEAN_CHECK_IN_TIME, 0.5, 1)[0]) * 60
-            )
             # Grab the amount of seconds needed to pass for this patient to renege
             # and the initial time at which they checked in.
             renege_time, checked_in_time = self.grab_renege_and_check_in_times(
-                patient_id
+                patient
             )
-            # Check to see if the length of time passed since arrival is greater
-            # than the renege time
-            if (self.env.now - checked_in_time) > renege_time:
-                # If time passed is greater than renege time, remove the patient
-                # from the check in queue and append the patient to the renegers
-                # list
-                self.check_in_queue.remove(patient_id)
-                self.renegers.append(patient_id)
-                logger.trace(
-                    f"{patient_id} removed from the check in queue after"
-                    + f" {self.env.now - checked_in_time} seconds in the check in "
-                    f"queue at time {self.env.now}."
-                )
+            # Wait for a receptionist, but only until the patient runs out of
+            # patience. Leaving the with block takes them out of the line.
+            patience = max(renege_time - (self.env.now - checked_in_time), 0)
+            results = yield req | self.env.timeout(patience)
+            if req not in results:
+                # If the patient gave up first, remove the patient from the
+                # check in queue and count them as a reneger
+                del self.check_in_queue[patient]
+                self.check_in_queue_stats.update(self.env.now, len(self.check_in_queue))
+                self.num_reneged += 1
+                if self.trace:
+                    logger.trace(
+                        f"{patient.label} removed from the check in queue after"
+                        + f" {self.env.now - checked_in_time} seconds in the check in "
+                        f"queue at time {self.env.now}."
+                    )
                 # Add the patient to the event log as Reneged
                 self.add_to_event_log(
-                    "Reneged From Check-In Queue", patient_id, self.env.now
+                    EventAction.RENEGED_CHECK_IN, patient, self.env.now
                 )
-                # Add Reneged and leave time to patient info df
-                self.patient_info_df.loc[
-                    self.patient_info_df["patient_id"] == patient_id, "action"
-                ] = "Reneged"
-                self.patient_info_df.loc[
-                    self.patient_info_df["patient_id"] == patient_id, "leave_time"
-                ] = self.env.now
+                # Add Reneged and leave time to the patient records
+                self.set_patient_outcome(patient, Outcome.RENEGED, self.env.now)
             else:
-                # If time passed has not surpassed the renege time
-                # After check in with receptionist time has passed
-                # continue with the simulation
-                yield self.env.timeout(check_in_line_time)
-                # log time speaking with receptionist and check in queue time
-                logger.trace(
-                    f"{patient_id} checked in to the vaccination queue after"
-                    + f" {check_in_line_time} seconds in the check in "
-                    f"queue at time {self.env.now}. The check-in queue wait "
-                    + f"time was {self.env.now - checked_in_time}"
-                )
-                # Remove the patient from the check in queue
-                self.check_in_queue.remove(patient_id)
-                # Add the patient to the vaccination queue
-                self.vaccination_queue.append(patient_id)
-                # Add move to vaccination queue to event log
-                self.add_to_event_log(
-                    "Switch to Vaccination Queue", patient_id, self.env.now
+                self.check_in_wait.add(self.env.now - patient.queued_at)
+                # Set a random amount of time taken to check in with the
+                # receptionist with a SD of 1 and a mean set in the program settings
+                check_in_line_time = (
+                    abs(
+                        self.check_in_stream.normal(self.config.mean_check_in_time, 0.5)
+                    )
+                    * 60
                 )
-                # Start the vaccination simulation
-                self.env.process(self.vaccinate(patient_id, time))
+                yield from self.finish_check_in(patient, check_in_line_time)
+
+    def finish_check_in(self, patient, check_in_line_time):
+        # After check in with receptionist time has passed
+        # continue with the simulation
+        patient.service_end = self.env.now + check_in_line_time
+        yield self.env.timeout(check_in_line_time)
+        patient.service_end = None
+        # log time speaking with receptionist and check in queue time
+        if self.trace:
+            logger.trace(
+                f"{patient.label} checked in to the vaccination queue after"
+                + f" {check_in_line_time} seconds in the check in "
+                f"queue at time {self.env.now}. The check-in queue wait "
+                + f"time was {self.env.now - patient.check_in_time}"
+            )
+        # Remove the patient from the check in queue
+        del self.check_in_queue[patient]
+        self.check_in_queue_stats.update(self.env.now, len(self.check_in_queue))
+        # Add the patient to the end of the vaccination queue
+        self.vaccination_queue[patient] = None
+        patient.queued_at = self.env.now
+        self.vaccination_queue_stats.update(self.env.now, len(self.vaccination_queue))
+        # Add move to vaccination queue to event log
+        self.add_to_event_log(EventAction.SWITCH_TO_VACCINATION, patient, self.env.now)
+        # Start the vaccination simulation
+        self.env.process(self.vaccinate(patient))
 
-    def grab_renege_and_check_in_times(self, patient_id):
+    def resume_check_in(self, patient, req):
+        # Finish the check in of a patient who was with a receptionist when
+        # the clinic was snapshotted
+        with req:
+            yield from self.finish_check_in(
+                patient, patient.service_end - self.env.now
+            )
+
+    def grab_renege_and_check_in_times(self, patient):
         # Check the amount of time a patient will stay in line
         # And the time they checked into the check in line
-        renege_time = self.patient_info_df.loc[
-            self.patient_info_df["patient_id"] == patient_id
-        ]["renege_max"].values[0]
-        checked_in_time = self.patient_info_df.loc[
-            self.patient_info_df["patient_id"] == patient_id
-        ]["check_in_time"].values[0]
-        return renege_time, checked_in_time
-
-    def add_to_event_log(self, action, patient_id, time):
-        # Add patient_id, action, and a timestamp to the event log
-        event_log_row = pd.DataFrame(
-            {"patient_id": [patient_id], "action": [action], "time": [time]}
+        return patient.renege_max, patient.check_in_time
+
+    def add_to_event_log(self, action, patient, time):
+        # Add the patient, action code, and a timestamp to the event log
+        self.event_records.append(
+            patient_number=patient.number,
+            scheduled=patient.scheduled,
+            action=action,
+            time=time,
         )
-        self.event_log_df = pd.concat([self.event_log_df, event_log_row])
 
-    def vaccinate(self, patient_id, time):
+    def vaccinate(self, patient):
         # Create a normal distribution with a mean of 2 and a SD of 1
         # and return the absolute value of that as the vaccination time.
-        time2 = self.env.now
-        # Check for nurses who are free and log the time they've been free
-        self.log_wasted_resource_time(self.nurse, time, time2)
         # When a nurse is free, set them up with a patient
         with self.nurse.request() as req:
-            yield req
-            # Randomize a vaccination time with MEAN_VACCINE_TIME setting and 1 minute
-            # standard deviation
-            vaccination_time = np.abs(np.random.normal(MEAN_VACCINE_TIME, 1, 1)[0]) * 60
             # Grab the amount of seconds needed to pass for this patient to renege
             # and the initial time at which they checked in.
             renege_time, checked_in_time = self.grab_renege_and_check_in_times(
-                patient_id
+                patient
             )
-            # If more time has passed than the renege amount
-            if (self.env.now - checked_in_time) > renege_time:
+            # Wait for a nurse until the patient's time in the clinic reaches
+            # their renege time
+            patience = max(renege_time - (self.env.now - checked_in_time), 0)
+            results = yield req | self.env.timeout(patience)
+            # If the patient ran out of patience before a nurse was free
+            if req not in results:
                 # Remove the patient from the vaccination queue
-                self.vaccination_queue.remove(patient_id)
-                # Append the patient to the renegers list
-                self.renegers.append(patient_id)
+                del self.vaccination_queue[patient]
+                self.vaccination_queue_stats.update(
+                    self.env.now, len(self.vaccination_queue)
+                )
+                # Count the patient as a reneger
+                self.num_reneged += 1
                 # Log the time reneged from the vaccination queue
                 # And time spent in line total
-                logger.trace(
-                    f"{patient_id} reneged from vaccination queue after"
-                    + f" {self.env.now - checked_in_time} combined seconds in "
-                    "the check in queue and vaccination queue "
-                    f"at time {self.env.now}."
-                )
+                if self.trace:
+                    logger.trace(
+                        f"{patient.label} reneged from vaccination queue after"
+                        + f" {self.env.now - checked_in_time} combined seconds in "
+                        "the check in queue and vaccination queue "
+                        f"at time {self.env.now}."
+                    )
                 # Log vaccination queue length after removing patient
-                self.vaccination_queue_length.append(
-                    [self.env.now, len(self.vaccination_queue)]
-                )
+                if self.vaccination_queue_length is not None:
+                    self.vaccination_queue_length.append(
+                        [self.env.now, len(self.vaccination_queue)]
+                    )
                 # Add reneging from Vaccination Queue to the event log
                 self.add_to_event_log(
-                    "Reneged From Vaccination Queue", patient_id, self.env.now
+                    EventAction.RENEGED_VACCINATION, patient, self.env.now
                 )
-                # Add reneging as an action to the patient dataframe
-                self.patient_info_df.loc[
-                    self.patient_info_df["patient_id"] == patient_id, "action"
-                ] = "Reneged"
-                # Add leave time to patient dataframe
-                self.patient_info_df.loc[
-                    self.patient_info_df["patient_id"] == patient_id, "leave_time"
-                ] = self.env.now
+                # Add reneging and leave time to the patient records
+                self.set_patient_outcome(patient, Outcome.RENEGED, self.env.now)
             else:
-                # If patient has not made it to their renege time
-                # Wait vaccination time for vaccination to complete
-                yield self.env.timeout(vaccination_time)
-                # Remove the patient from the vaccination queue
-                self.vaccination_queue.remove(patient_id)
-                # Log the time vaccination completed
-                logger.trace(
-                    f"{patient_id} spent {vaccination_time} with the nurse "
-                    + f"at time {self.env.now}. The vaccination"
-                    f" queue length is {(len(self.vaccination_queue))}."
+                self.vaccination_wait.add(self.env.now - patient.queued_at)
+                # Randomize a vaccination time with the mean vaccine time setting
+                # and 1 minute standard deviation
+                vaccination_time = (
+                    abs(
+                        self.vaccination_stream.normal(self.config.mean_vaccine_time, 1)
+                    )
+                    * 60
                 )
-                # Log the vaccination queue length after removing the patient
-                self.vaccination_queue_length.append(
-                    [self.env.now, len(self.vaccination_queue)]
-                )
-                # Add vaccination to the event log
-                self.add_to_event_log("Vaccinated", patient_id, self.env.now)
-                # Log that the patient was vaccinated successfully in the patient df
-                self.patient_info_df.loc[
-                    self.patient_info_df["patient_id"] == patient_id, "action"
-                ] = "Vaccinated"
-                # Log time vaccinated
-                self.patient_info_df.loc[
-                    self.patient_info_df["patient_id"] == patient_id, "leave_time"
-                ] = self.env.now
-                self.vaccinated.append(patient_id)
-
-    def arrive(self):
-        # Function set for walk-in arrivals
-
-        # Initialize patient ID
-        patient_id = 0
+                yield from self.finish_vaccination(patient, vaccination_time)
+
+    def finish_vaccination(self, patient, vaccination_time):
+        # Wait vaccination time for vaccination to complete
+        patient.service_end = self.env.now + vaccination_time
+        yield self.env.timeout(vaccination_time)
+        # Remove the patient from the vaccination queue
+        del self.vaccination_queue[patient]
+        self.vaccination_queue_stats.update(self.env.now, len(self.vaccination_queue))
+        # Log the time vaccination completed
+        if self.trace:
+            logger.trace(
+                f"{patient.label} spent {vaccination_time} with the nurse "
+                + f"at time {self.env.now}. The vaccination"
+                f" queue length is {(len(self.vaccination_queue))}."
+            )
+        # Log the vaccination queue length after removing the patient
+        if self.vaccination_queue_length is not None:
+            self.vaccination_queue_length.append(
+                [self.env.now, len(self.vaccination_queue)]
+            )
+        # Add vaccination to the event log
+        self.add_to_event_log(EventAction.VACCINATED, patient, self.env.now)
+        # Log that the patient was vaccinated in the patient records
+        self.set_patient_outcome(patient, Outcome.VACCINATED, self.env.now)
+        self.num_vaccinated += 1
+
+    def resume_vaccination(self, patient, req):
+        # Finish the vaccination of a patient who was with a nurse when the
+        # clinic was snapshotted
+        with req:
+            yield from self.finish_vaccination(
+                patient, patient.service_end - self.env.now
+            )
+
+    def arrive(self, time_between_arrivals=None):
+        # Function set for walk-in arrivals. A clinic restored from a snapshot
+        # passes the wait until the next walk-in, which was already drawn.
+
         # Start infinite loop to open vaccine clinic for walk-ins
         while True:
-            time_to_send = self.env.now
-            # Set the average time between arrivals to 30 seconds with 15 seconds
-            # standard deviation and randomize
-            time_between_arrivals = self.create_patient_flow_rates(
-                HIGH_FLOW_RATE, LOW_FLOW_RATE
-            )
+            if time_between_arrivals is None and self.walk_in_times is None:
+                # Set the average time between arrivals to 30 seconds with 15
+                # seconds standard deviation and randomize
+                time_between_arrivals = self.create_patient_flow_rates(
+                    self.config.high_flow_rate, self.config.low_flow_rate
+                )
+            elif time_between_arrivals is None:
+                # Replay the next walk-in of the day's timeline, stopping
+                # once it runs out
+                if self.walk_in_index == len(self.walk_in_times):
+                    self.next_walk_in = None
+                    return False
+                next_time = self.opened_at + self.walk_in_times[self.walk_in_index]
+                self.walk_in_index += 1
+                time_between_arrivals = max(next_time - self.env.now, 0)
+            # Remember when the next walk-in comes for snapshots
+            self.next_walk_in = self.env.now + time_between_arrivals
             # Wait until someone arrives to continue
             yield self.env.timeout(time_between_arrivals)
-            # Add patient ID
-            patient_id += 1
+            time_between_arrivals = None
+            # Add patient number
+            self.num_walk_ins += 1
             # Randomize the patient type between 'Rushed' and 'Relaxed'
-            patient = self.randomize_patient_type(patient_id)
-            # Check for the length of check-in queue line that will make the
-            # patient leave without entering the queue
-            balking_queue_length = patient.loc[patient["patient_id"] == patient_id][
-                "balk_max"
-            ].values[0]
+            patient = self.randomize_patient_type(self.num_walk_ins)
             # set the time added to the check in queue
             time = self.env.now
             yield self.env.timeout(0)
-            # If the check in queue is shorter than the balk length
-            if balking_queue_length > len(self.check_in_queue):
-                # Add the patient to the event log as joining check in queue
-                self.add_to_event_log("Join Check-in Queue", patient_id, time)
-                # Log patient joining check in queue
+            self.walk_in(patient, time)
+            # If closing time has occurred, stop allowing walk ins
+            if self.env.now - self.opened_at >= self.config.sim_secs:
+                self.next_walk_in = None
+                return False
+
+    def walk_in(self, patient, time):
+        # If the check in queue is shorter than the length of line
+        # that will make the patient leave without entering it
+        if patient.balk_max > len(self.check_in_queue):
+            # Add the patient to the event log as joining check in queue
+            self.add_to_event_log(EventAction.JOIN_CHECK_IN, patient, time)
+            # Log patient joining check in queue
+            if self.trace:
                 logger.trace(
-                    f"{patient_id} added to check-in queue at time {time}. "
+                    f"{patient.label} added to check-in queue at time {time}. "
                     + f"The queue length is {len(self.check_in_queue)}"
                 )
-                # Add patient to the check in queue
-                self.check_in_queue.append(patient_id)
-                # Start the check in process with a normal priority
-                self.env.process(
-                    self.check_in(patient_id, patient_priority=0, time=time_to_send)
-                )
-            else:
-                # If the check in queue is too long
-                # Add patient to the event log as balking
-                self.add_to_event_log("balk", patient_id, time)
-                # Log the balk
+            # Add patient to the end of the check in queue
+            self.check_in_queue[patient] = None
+            self.check_in_queue_stats.update(self.env.now, len(self.check_in_queue))
+            # Start the check in process with a normal priority
+            self.env.process(self.check_in(patient, patient_priority=0))
+        else:
+            # If the check in queue is too long
+            # Add patient to the event log as balking
+            self.add_to_event_log(EventAction.BALK, patient, time)
+            # Log the balk
+            if self.trace:
                 logger.trace(
-                    f"{patient_id} has balked at the check in line at time {time}"
+                    f"{patient.label} has balked at the check in line at time {time}"
                 )
-                # Add the patient to the list of balkers
-                self.balkers.append(patient_id)
-                # Set the action as balked in the patient dataframe
-                self.patient_info_df.loc[
-                    self.patient_info_df["patient_id"] == patient_id, "action"
-                ] = "Balked"
-                # Set the time balked in the patient dataframe
-                self.patient_info_df.loc[
-                    self.patient_info_df["patient_id"] == patient_id, "leave_time"
-                ] = self.env.now
-            # Add the length of the check in queue to the check in queue length list
+            # Count the patient as a balker
+            self.num_balked += 1
+            # Set the action and time balked in the patient records
+            self.set_patient_outcome(patient, Outcome.BALKED, self.env.now)
+        # Add the length of the check in queue to the check in queue length list
+        if self.check_in_queue_length is not None:
             self.check_in_queue_length.append([time, len(self.check_in_queue)])
-            # If closing time has occurred, stop allowing walk ins
-            if self.env.now >= SIM_SECS:
-                return False
 
-    def scheduled_arrivals(self):
-        # Function set for appointments
+    def scheduled_arrivals(self, time_until_appointment=None):
+        # Function set for appointments. A clinic restored from a snapshot
+        # passes the wait until the next appointment.
 
-        # Initialize the patient ID with a Prefix of A for Appt
-        patient_id = "A_0"
         # Start allowing appointments to happen
         while True:
             # Add a patient with an appointment based on the appointment
             # Frequency set in the program settings
-            yield self.env.timeout(APPOINTMENT_FREQ)
-            # Add 1 to patient ID to keep it unique
-            prefix, suffix = patient_id.split("_")
-            patient_id = f"{prefix}_{int(suffix) + 1}"
+            if time_until_appointment is None and self.appointment_times is None:
+                time_until_appointment = self.config.appointment_freq
+            elif time_until_appointment is None:
+                # Take the next appointment in the book, stopping once it runs out
+                if self.appointment_index == len(self.appointment_times):
+                    self.next_appointment = None
+                    return False
+                next_time = (
+                    self.opened_at + self.appointment_times[self.appointment_index]
+                )
+                self.appointment_index += 1
+                time_until_appointment = max(next_time - self.env.now, 0)
+            # Remember when the next appointment is for snapshots
+            self.next_appointment = self.env.now + time_until_appointment
+            yield self.env.timeout(time_until_appointment)
+            time_until_appointment = None
+            # Add 1 to the appointment number to keep it unique, shown with a
+            # prefix of A for Appt
+            self.num_appointments += 1
             # Set the time of arrival
             time = self.env.now
-            # Create a row for the scheduled patient
-            scheduled_patient = pd.DataFrame(
-                {
-                    "patient_id": [patient_id],
-                    "patient_type": ["Scheduled"],
-                    "balk_max": [20],
-                    "renege_max": [1800],
-                    "check_in_time": [time],
-                    "leave_time": [0],
-                    "action": [0],
-                }
+            # Add the scheduled patient to the patient records
+            patient = self.add_patient(
+                Patient(
+                    self.num_appointments, True, PatientType.SCHEDULED, 20, 1800, time
+                )
             )
-            # Add the row to the patient info dataframe
-            self.patient_info_df = pd.concat([self.patient_info_df, scheduled_patient])
             yield self.env.timeout(0)
             # Add check in queue join to the event log
-            self.add_to_event_log("Join Check-in Queue", patient_id, time)
+            self.add_to_event_log(EventAction.JOIN_CHECK_IN, patient, time)
             # Log patient going to front of check in queue line
-            logger.trace(
-                f"{patient_id} added to front of check-in queue at time {time}. "
-                + f"The queue length is {len(self.check_in_queue)}"
-            )
+            if self.trace:
+                logger.trace(
+                    f"{patient.label} added to front of check-in queue at time {time}. "
+                    + f"The queue length is {len(self.check_in_queue)}"
+                )
             # Insert the patient into the number 1 spot in the check in queue
-            self.check_in_queue.insert(0, patient_id)
+            self.check_in_queue[patient] = None
+            self.check_in_queue.move_to_end(patient, last=False)
+            self.check_in_queue_stats.update(self.env.now, len(self.check_in_queue))
             # Initialize the check in process for the patient with a priority
             # That sets them next in line
-            self.env.process(self.check_in(patient_id, patient_priority=-1, time=time))
+            self.env.process(self.check_in(patient, patient_priority=-1))
             # Check the length of the check in queue and append it to the list
-            self.check_in_queue_length.append([time, len(self.check_in_queue)])
+            if self.check_in_queue_length is not None:
+                self.check_in_queue_length.append([time, len(self.check_in_queue)])
             # If closing time, allow no more scheduled patients
-            if self.env.now >= SIM_SECS:
+            if self.env.now - self.opened_at >= self.config.sim_secs:
+                self.next_appointment = None
                 return False
 
-    def randomize_patient_type(self, patient_id):
+    def randomize_patient_type(self, patient_number):
         # If a person is rushed, they will wait in a line of 5 or less
         # people and will wait in line for 5 times the mean vaccination
         # time plus mean check in time
-        if np.random.binomial(1, RUSHED_PCT / 100) == 1:
-            patient_type = "rushed"
+        mean_visit_time = self.config.mean_check_in_time + self.config.mean_vaccine_time
+        if self.patient_type_stream.next() < self.config.rushed_pct / 100:
+            patient_type = PatientType.RUSHED
             balk_max = 5
-            renege_max = 5 * (MEAN_CHECK_IN_TIME + MEAN_VACCINE_TIME) * 60
+            renege_max = 5 * mean_visit_time * 60
         # If a person is relaxed, they will wait in a line of 15 or less
         # people and will wait in line for 15 times the mean vaccination
         # time plus mean check in time
         else:
-            patient_type = "relaxed"
+            patient_type = PatientType.RELAXED
             balk_max = 15
-            renege_max = 15 * (MEAN_CHECK_IN_TIME + MEAN_VACCINE_TIME) * 60
-        new_patient = pd.DataFrame(
-            {
-                "patient_id": [patient_id],
-                "patient_type": [patient_type],
-                "balk_max": [balk_max],
-                "renege_max": [renege_max],
-                "check_in_time": [self.env.now],
-                "leave_time": [0],
-                "action": [0],
-            }
+            renege_max = 15 * mean_visit_time * 60
+        # Add the patient to the patient records and return them
+        return self.add_patient(
+            Patient(
+                patient_number, False, patient_type, balk_max, renege_max, self.env.now
+            )
         )
-        self.patient_info_df = pd.concat([self.patient_info_df, new_patient])
-        return pd.concat([self.patient_info_df, new_patient])
 
     def create_patient_flow_rates(self, high_flow_rate, low_flow_rate):
         """
         high_flow_rate {float}: Mins between average patient walk in for high flow times
         low_flow_rate {float}: mins between average patient walk in for low flow times
         """
-        time = self.env.now
+        time = self.env.now - self.opened_at
         # If it's between 7 am and 9 am
         if time < (7200):
             # Use the high flow rate to designate before work hours
             time_between_arrivals = (
-                np.abs(np.random.normal(high_flow_rate, high_flow_rate / 2, 1)[0]) * 60
+                abs(self.arrival_stream.normal(high_flow_rate, high_flow_rate / 2)) * 60
             )
         elif 7200 <= time <= 14400:
             # If it's between 9 am and 11 am use the low flow rate
             time_between_arrivals = (
-                np.abs(np.random.normal(low_flow_rate, low_flow_rate / 2, 1)[0]) * 60
+                abs(self.arrival_stream.normal(low_flow_rate, low_flow_rate / 2)) * 60
             )
         elif 14400 < time < 25200:
             # If it's between 11 am and 2 pm use the high flow rate
             time_between_arrivals = (
-                np.abs(np.random.normal(high_flow_rate, high_flow_rate / 2, 1)[0]) * 60
+                abs(self.arrival_stream.normal(high_flow_rate, high_flow_rate / 2)) * 60
             )
         elif 25200 <= time <= 36000:
             # If it's between 2 pm and 5 pm use low flow rate
             time_between_arrivals = (
-                np.abs(np.random.normal(low_flow_rate, low_flow_rate / 2, 1)[0]) * 60
+                abs(self.arrival_stream.normal(low_flow_rate, low_flow_rate / 2)) * 60
             )
         elif time > 36000:
             # If it's after 5 pm to close use the high flow rate
             time_between_arrivals = (
-                np.abs(np.random.normal(high_flow_rate, high_flow_rate / 2, 1)[0]) * 60
+                abs(self.arrival_stream.normal(high_flow_rate, high_flow_rate / 2)) * 60
             )
         return time_between_arrivals
 
@@ -401,7 +1114,11 @@ class VaccineClinic(object):
 def create_excel_files(clinic, unique_names=False):
     # If suffix is True, add variable amounts to each excel file
     if unique_names:
-        suffix = f"-{NUM_RECEPTIONISTS}R-{NUM_NURSES}N-{int(APPOINTMENT_FREQ/60)}A"
+        config = clinic.config
+        suffix = (
+            f"-{config.num_receptionists}R-{config.num_nurses}N-"
+            + f"{int(config.appointment_freq/60)}A"
+        )
     else:
         suffix = ""
     # create event log excel file
@@ -409,16 +1126,22 @@ def create_excel_files(clinic, unique_names=False):
         f"Vaccine_Clinic_Log{suffix}.xlsx",
         index=False,
     )
-    # Create Vax Queue length excel file
-    vax_queue_df = pd.DataFrame(
-        clinic.vaccination_queue_length, columns=["time", "vaccination_queue_length"]
-    )
-    vax_queue_df.to_excel(f"vaccination_queue_length{suffix}.xlsx", index=False)
-    # Create Check-In Queue length excel file
-    check_in_queue_df = pd.DataFrame(
-        clinic.check_in_queue_length, columns=["time", "check_in_queue_length"]
+    if clinic.config.queue_traces:
+        # Create Vax Queue length excel file
+        vax_queue_df = pd.DataFrame(
+            clinic.vaccination_queue_length,
+            columns=["time", "vaccination_queue_length"],
+        )
+        vax_queue_df.to_excel(f"vaccination_queue_length{suffix}.xlsx", index=False)
+        # Create Check-In Queue length excel file
+        check_in_queue_df = pd.DataFrame(
+            clinic.check_in_queue_length, columns=["time", "check_in_queue_length"]
+        )
+        check_in_queue_df.to_excel(f"check_in_queue_length{suffix}.xlsx", index=False)
+    # Create the queue and wait time statistics excel file
+    pd.DataFrame([clinic.statistics_summary()]).to_excel(
+        f"queue_statistics{suffix}.xlsx", index=False
     )
-    check_in_queue_df.to_excel(f"check_in_queue_length{suffix}.xlsx", index=False)
     # Calculate the total time each patient spent at the clinic
     clinic.patient_info_df["service_time"] = (
         clinic.patient_info_df["leave_time"] - clinic.patient_info_df["check_in_time"]
@@ -433,95 +1156,604 @@ def create_excel_files(clinic, unique_names=False):
     clinic.patient_info_df[clinic.patient_info_df["action"] == "Reneged"].to_excel(
         f"patient_renege_df{suffix}.xlsx", index=False
     )
-    # Create a nurse wasted time excel file from available nurse times
-    nurse_wasted_df = pd.DataFrame(
-        clinic.nurse_wasted_time, columns=["Nurse Free Time"]
+    # Create a resource utilization excel file with the busy and free time
+    # of the receptionists and nurses
+    utilization_df = pd.DataFrame(
+        [
+            {"Resource": "Receptionist", **clinic.receptionist.summary()},
+            {"Resource": "Nurse", **clinic.nurse.summary()},
+        ]
     )
-    nurse_wasted_df.to_excel(f"nurse_wasted_time{suffix}.xlsx", index=False)
-    # Create a receptionist wasted time excel file from available receptionist times
-    receptionist_wasted_df = pd.DataFrame(
-        clinic.receptionist_wasted_time, columns=["Receptionist Free Time"]
-    )
-    receptionist_wasted_df.to_excel(
-        f"Receptionist_wasted_time{suffix}.xlsx", index=False
+    utilization_df.to_excel(f"resource_utilization{suffix}.xlsx", index=False)
+
+
+def read_dataset(output_dir, table, columns=None):
+    # Read one Parquet table of a sweep back as a DataFrame, with the
+    # receptionists, nurses, replication and seed partitions as columns
+    return pq.read_table(os.path.join(output_dir, table), columns=columns).to_pandas()
+
+
+def export_excel_summary(output_dir, path):
+    # Post-process a sweep's Parquet output into a small Excel workbook: the
+    # patient outcome counts and resource utilization of every run
+    partition_keys = ["receptionists", "nurses", "replication", "seed"]
+    patients = read_dataset(output_dir, "patient_info", ["action"] + partition_keys)
+    patients["action"] = OUTCOME_LABELS[patients["action"].to_numpy()]
+    outcomes = (
+        patients.groupby(partition_keys + ["action"], observed=True)
+        .size()
+        .unstack(fill_value=0)
+        .reset_index()
     )
+    utilization = read_dataset(output_dir, "resource_utilization")
+    with pd.ExcelWriter(path) as writer:
+        outcomes.to_excel(writer, sheet_name="Outcomes", index=False)
+        utilization.to_excel(writer, sheet_name="Resource Utilization", index=False)
 
 
-RUSHED_PCT = 25  # Set percent of rushed patients
-MEAN_VACCINE_TIME = 3
-MEAN_CHECK_IN_TIME = 1
-HIGH_FLOW_RATE = 0.25
-LOW_FLOW_RATE = 0.5
-APPOINTMENT_FREQ = 15 * 60  # Appts every 15 mins
-NUM_NURSES = 1
-NUM_RECEPTIONISTS = 1
-REPRODUCIBLE = True  # Use same random seeding if reproducible is true
-SIM_HRS = 12
-SIM_SECS = SIM_HRS * 60 * 60
-# Set up the logging
-logger.add(sys.stderr, format="{message}", level="TRACE")
-logger.add(
-    f"Vaccine_Clinic_{SIM_HRS} Hrs -{NUM_RECEPTIONISTS} Recpts-{NUM_NURSES} Nurses-{int(APPOINTMENT_FREQ/60)} min Appts.log",
-    level="TRACE",
-    format="{message}",
-)
-logger.add("Summary_Output.log", level="INFO", format="{message}")
-# Set the random seed if reproducible set to true
-if REPRODUCIBLE:
-    np.random.seed(1112)
-scenarios = []
-for i in range(1, 11):
-    for j in range(1, 11):
-        scenarios.append([i, j])
-
-tic = time.perf_counter()
-num_nurses = []
-num_receptionists = []
-num_balkers = []
-num_renegers = []
-num_vaccinated = []
-
-for scenario in scenarios:
+def scenario_seed(
+    base_seed, num_receptionists, num_nurses, replication=0, common_random_numbers=False
+):
+    # Derive an independent seed for one run from the base seed. The seed only
+    # depends on the scenario and replication, not on the order runs execute in.
+    # With common random numbers every staffing level of a replication shares
+    # a seed, so they see the same patients and service times.
+    if common_random_numbers:
+        seed_seq = np.random.SeedSequence([base_seed, replication])
+    else:
+        seed_seq = np.random.SeedSequence(
+            [base_seed, num_receptionists, num_nurses, replication]
+        )
+    return int(seed_seq.generate_state(1)[0])
+
+
+def run_scenario(config, output=None, env=None, profiler=None):
+    # Run one clinic day for the config and return the finished clinic, with
+    # its patient and event DataFrames built. Nothing outside the run is touched,
+    # so configs can be run side by side in one process. If a ParquetOutput is
+    # given the run's records are streamed to it. A fresh simpy.Environment is
+    # used unless one is given (e.g. an instrumented subclass). If a RunProfiler
+    # is given the run uses its environment and is profiled.
     # Initialize the environment
-    env = simpy.Environment()
-    # Initialize the clinic
-    clinic = VaccineClinic(env, scenario[0], scenario[1])
+    if profiler is not None:
+        env = profiler.env
+    elif env is None:
+        env = simpy.Environment()
+    # Initialize the clinic with its random streams seeded for this run
+    clinic = VaccineClinic(env, config, output)
+    if profiler is not None:
+        profiler.attach(clinic)
+        profiler.start()
     # Start the scheduled arrivals process for the environment
     env.process(clinic.scheduled_arrivals())
     # Start the walk in arrivals process for the environment
     env.process(clinic.arrive())
     # Run the environment
+    try:
+        env.run()
+    finally:
+        if profiler is not None:
+            profiler.stop()
+    # Build the patient and event DataFrames from the run's records
+    clinic.finalize_records()
+    return clinic
+
+
+def snapshot_scenario(config, time):
+    # Run a clinic for the config from opening until the given time and
+    # return a snapshot of it, e.g. to branch what-ifs from
+    env = simpy.Environment()
+    clinic = VaccineClinic(env, config)
+    env.process(clinic.scheduled_arrivals())
+    env.process(clinic.arrive())
+    env.run(until=time)
+    return clinic.snapshot()
+
+
+def resume_scenario(snapshot, config=None):
+    # Carry on a run from a snapshot to the end of the day, with the
+    # snapshot's config or a changed one, and return the finished clinic
+    env = simpy.Environment(initial_time=snapshot.time)
+    clinic = VaccineClinic.from_snapshot(env, snapshot, config)
     env.run()
+    clinic.finalize_records()
+    return clinic
+
+
+def simulate_what_if(task):
+    # Worker entry point: carry on one (snapshot, config) what-if and send
+    # back only its summary row
+    snapshot, config = task
+    row = summarize_clinic(resume_scenario(snapshot, config))
+    row["Branch Time"] = snapshot.time
+    return row
+
+
+def run_what_ifs(snapshot, configs, max_workers=None):
+    """
+    snapshot {ClinicSnapshot}: Shared start of every what-if
+    configs {list}: ClinicConfig of each what-if, e.g. the snapshot's config
+        with one more nurse
+    max_workers {int}: Worker processes, None for one per CPU, 1 to run in-process
+
+    Returns the summary row of each what-if, in the order of configs.
+    """
+    tasks = [(snapshot, config) for config in configs]
+    with open_executor(max_workers) as executor:
+        return list(map_tasks(tasks, executor, simulate_what_if))
+
+
+def summarize_clinic(clinic):
+    # Collect the summary metrics of a finished run into one row
+    return {
+        "Nurses": clinic.num_nurses,
+        "Receptionists": clinic.num_receptionists,
+        "Balkers": clinic.num_balked,
+        "Renegers": clinic.num_reneged,
+        "Vaccinated": clinic.num_vaccinated,
+        "Nurse Free Time": clinic.nurse.idle_time,
+        "Receptionist Free Time": clinic.receptionist.idle_time,
+        "Nurse Utilization": clinic.nurse.utilization(),
+        "Receptionist Utilization": clinic.receptionist.utilization(),
+        **clinic.statistics_summary(),
+    }
 
+
+def simulate_scenario(task):
+    # Worker entry point: run one (config, replication) task and send back
+    # only its summary row
+    config, replication = task
+    output = None
+    if config.output_dir is not None:
+        # Partition this run's Parquet records by scenario, replication and seed
+        output = ParquetOutput(
+            config.output_dir,
+            {
+                "receptionists": config.num_receptionists,
+                "nurses": config.num_nurses,
+                "replication": replication,
+                "seed": config.seed,
+            },
+        )
+    profiler = RunProfiler() if config.profile else None
+    clinic = run_scenario(config, output, profiler=profiler)
     # create_excel_files(clinic, True)
-    logger.info(f"{scenario[0]} Receptionists | {scenario[1]} Nurses")
+    row = summarize_clinic(clinic)
+    row["Replication"] = replication
+    row["Seed"] = config.seed
+    if profiler is not None:
+        # Send the timings and sampled stacks back with the summary
+        row.update(profiler.summary())
+        row["Profile Stacks"] = profiler.stacks
+    return row
+
+
+def log_scenario_summary(row):
+    # Write the summary of one run to the summary log
+    logger.info(f"{row['Receptionists']} Receptionists | {row['Nurses']} Nurses")
     logger.info("===========================================================")
-    logger.info(f"Nurses spent {sum(clinic.nurse_wasted_time)} seconds free.")
+    logger.info(f"Nurses spent {row['Nurse Free Time']} seconds free.")
+    logger.info(f"Receptionists spent {row['Receptionist Free Time']} seconds free.")
+    logger.info(f"{row['Renegers']} patients reneged during their visit.")
+    logger.info(f"{row['Balkers']} patients balked from the check in queue.")
+    logger.info(f"{row['Vaccinated']} patients were successfully vaccinated.")
     logger.info(
-        f"Receptionists spent {sum(clinic.receptionist_wasted_time)} seconds free."
+        f"{round(row['Vaccinated']/(row['Vaccinated'] + row['Balkers'] + row['Renegers']) * 100, 1)} "
+        + f"percent of patients were successfully vaccinated with {row['Receptionists']} receptionists "
+        + f"and {row['Nurses']} nurses working.\n\n"
     )
-    logger.info(f"{len(clinic.renegers)} patients reneged during their visit.")
-    logger.info(f"{len(clinic.balkers)} patients balked from the check in queue.")
-    logger.info(f"{len(clinic.vaccinated)} patients were successfully vaccinated.")
-    logger.info(
-        f"{round(len(clinic.vaccinated)/(len(clinic.vaccinated) + len(clinic.balkers) + len(clinic.renegers)) * 100, 1)} "
-        + f"percent of patients were successfully vaccinated with {scenario[0]} receptionists "
-        + f"and {scenario[1]} nurses working.\n\n"
+
+
+def make_tasks(
+    config,
+    scenarios,
+    base_seed,
+    replications,
+    first_replication=0,
+    common_random_numbers=False,
+):
+    # Build one (config, replication) task per run, with the staffing and
+    # seed of the run filled into the base config
+    return [
+        (
+            replace(
+                config,
+                num_receptionists=num_receptionists,
+                num_nurses=num_nurses,
+                seed=scenario_seed(
+                    base_seed,
+                    num_receptionists,
+                    num_nurses,
+                    replication,
+                    common_random_numbers,
+                ),
+            ),
+            replication,
+        )
+        for num_receptionists, num_nurses in scenarios
+        for replication in range(first_replication, replications)
+    ]
+
+
+def open_executor(max_workers):
+    # Skip the pool overhead when running on a single core
+    if max_workers == 1:
+        return nullcontext(None)
+    return ProcessPoolExecutor(max_workers=max_workers)
+
+
+def map_tasks(tasks, executor, function=None, cache=None):
+    # map hands back results in task order as soon as each one is ready.
+    # Tasks are run by simulate_scenario unless another function is given.
+    # With a ResultCache, only (config, replication) tasks it has no row for
+    # are simulated.
+    function = simulate_scenario if function is None else function
+    if cache is not None:
+        return map_cached_tasks(tasks, executor, function, cache)
+    if executor is None:
+        return map(function, tasks)
+    return executor.map(function, tasks)
+
+
+def map_cached_tasks(tasks, executor, function, cache):
+    # Hand back the cached rows and the rows of the tasks that had to run, in
+    # task order, storing each new row as it comes back
+    cached = cache.get_many(tasks)
+    missing = [task for index, task in enumerate(tasks) if index not in cached]
+    results = map_tasks(missing, executor, function)
+    for index, task in enumerate(tasks):
+        if index in cached:
+            yield cached[index]
+        else:
+            row = next(results)
+            cache.put(task, row)
+            yield row
+
+
+def run_sweep(
+    config,
+    scenarios,
+    base_seed,
+    replications=1,
+    max_workers=None,
+    common_random_numbers=False,
+    cache=None,
+):
+    """
+    config {ClinicConfig}: Parameters shared by every run
+    scenarios {list}: [num_receptionists, num_nurses] pairs to simulate
+    base_seed {int}: Seed every run's seed is derived from
+    replications {int}: Independent runs of each scenario
+    max_workers {int}: Worker processes, None for one per CPU, 1 to run in-process
+    common_random_numbers {bool}: Give every staffing level the same seeds
+    cache {ResultCache}: Cache of earlier runs' rows, None to run everything
+
+    Yields one summary row per run in scenario order, whatever the worker count.
+    """
+    tasks = make_tasks(
+        config,
+        scenarios,
+        base_seed,
+        replications,
+        common_random_numbers=common_random_numbers,
+    )
+    with open_executor(max_workers) as executor:
+        yield from map_tasks(tasks, executor, cache=cache)
+
+
+def t_interval_mass(t, dof):
+    # Probability a Student t variate with an integer dof lies within
+    # (-t, t), from the finite cosine series of Abramowitz & Stegun 26.7.3
+    theta = math.atan(t / math.sqrt(dof))
+    cos2 = math.cos(theta) ** 2
+    if dof % 2:
+        term, total = math.cos(theta), 0.0
+        for k in range(1, dof - 1, 2):
+            total += term
+            term *= cos2 * (k + 1) / (k + 2)
+        return 2 / math.pi * (theta + math.sin(theta) * total)
+    term, total = 1.0, 0.0
+    for k in range(1, dof, 2):
+        total += term
+        term *= cos2 * k / (k + 1)
+    return math.sin(theta) * total
+
+
+def t_critical(confidence, dof):
+    # Two-sided Student t critical value. One and two degrees of freedom have
+    # closed forms. Above that, the Cornish-Fisher expansion of the normal
+    # quantile is only good to about 0.2 at small dof, so it is the starting
+    # point of Newton steps on the exact interval mass
+    p = 0.5 + confidence / 2
+    if dof == 1:
+        return float(np.tan(np.pi * (p - 0.5)))
+    if dof == 2:
+        return float((2 * p - 1) / np.sqrt(2 * p * (1 - p)))
+    z = NormalDist().inv_cdf(p)
+    t = (
+        z
+        + (z**3 + z) / (4 * dof)
+        + (5 * z**5 + 16 * z**3 + 3 * z) / (96 * dof**2)
+        + (3 * z**7 + 19 * z**5 + 17 * z**3 - 15 * z) / (384 * dof**3)
     )
-    num_nurses.append(scenario[1])
-    num_receptionists.append(scenario[0])
-    num_renegers.append(len(clinic.renegers))
-    num_balkers.append(len(clinic.balkers))
-    num_vaccinated.append(len(clinic.vaccinated))
-toc = time.perf_counter()
-ic(f"{toc-tic} seconds have passed.")
-summary_runs_df = pd.DataFrame(
-    {
-        "Nurses": num_nurses,
-        "Receptionists": num_receptionists,
-        "Balkers": num_balkers,
-        "Renegers": num_renegers,
-        "Vaccinated": num_vaccinated,
+    log_scale = (
+        math.lgamma((dof + 1) / 2)
+        - math.lgamma(dof / 2)
+        - 0.5 * math.log(dof * math.pi)
+    )
+    for _ in range(20):
+        # The interval mass grows at twice the t density
+        density = math.exp(log_scale - (dof + 1) / 2 * math.log1p(t * t / dof))
+        step = (t_interval_mass(t, dof) - confidence) / (2 * density)
+        t -= step
+        if abs(step) < 1e-12 * t:
+            break
+    return t
+
+
+def replication_stats(rows, confidence=0.95, metrics=None):
+    # Mean, standard deviation and confidence interval of each replication
+    # metric (REPLICATION_METRICS unless given) over the runs of one scenario
+    stats = {
+        "Nurses": rows[0]["Nurses"],
+        "Receptionists": rows[0]["Receptionists"],
+        "Replications": len(rows),
     }
-)
-summary_runs_df.to_excel("summary_runs.xlsx", index=False)
+    for metric in metrics or REPLICATION_METRICS:
+        values = np.array([row[metric] for row in rows], dtype=float)
+        mean = values.mean()
+        if len(values) > 1:
+            sd = values.std(ddof=1)
+            half_width = t_critical(confidence, len(values) - 1) * sd / np.sqrt(
+                len(values)
+            )
+        else:
+            # A single run gives no variance estimate
+            sd = np.nan
+            half_width = np.inf
+        stats[f"{metric} Mean"] = mean
+        stats[f"{metric} SD"] = sd
+        stats[f"{metric} CI Low"] = mean - half_width
+        stats[f"{metric} CI High"] = mean + half_width
+        stats[f"{metric} Half Width"] = half_width
+    return stats
+
+
+def replications_needed(stats, rel_precision, stop_metrics):
+    # Estimate how many replications bring every stopping metric's CI
+    # half-width under rel_precision times its mean, since the half-width
+    # shrinks with the square root of the replication count
+    needed = stats["Replications"]
+    for metric in stop_metrics:
+        half_width = stats[f"{metric} Half Width"]
+        target = rel_precision * abs(stats[f"{metric} Mean"])
+        if half_width <= target:
+            continue
+        if not np.isfinite(half_width) or target == 0:
+            # Not enough data (or a zero mean) to estimate, just add one more
+            needed = max(needed, stats["Replications"] + 1)
+        else:
+            needed = max(
+                needed, int(np.ceil(stats["Replications"] * (half_width / target) ** 2))
+            )
+    return needed
+
+
+def run_replications(
+    config,
+    scenarios,
+    base_seed,
+    min_replications=5,
+    max_replications=50,
+    confidence=0.95,
+    rel_precision=0.02,
+    stop_metrics=("Vaccinated",),
+    max_workers=None,
+    common_random_numbers=False,
+    cache=None,
+):
+    """
+    config {ClinicConfig}: Parameters shared by every run
+    scenarios {list}: [num_receptionists, num_nurses] pairs to simulate
+    base_seed {int}: Seed every run's seed is derived from
+    min_replications {int}: Replications every scenario gets before stopping
+    max_replications {int}: Cap on replications for scenarios that never converge
+    confidence {float}: Confidence level of the intervals
+    rel_precision {float}: Stop once the CI half-width is under this fraction
+        of the mean for every metric in stop_metrics
+    stop_metrics {tuple}: Summary metrics the stopping rule checks
+    max_workers {int}: Worker processes, None for one per CPU, 1 to run in-process
+    common_random_numbers {bool}: Give every staffing level the same seeds
+    cache {ResultCache}: Cache of earlier runs' rows, None to run everything
+
+    Yields (stats row, run rows) for each scenario once it has converged or
+    reached max_replications. Output does not depend on the worker count.
+    """
+    runs = {tuple(scenario): [] for scenario in scenarios}
+    targets = {scenario: min_replications for scenario in runs}
+    with open_executor(max_workers) as executor:
+        while targets:
+            # Run every unfinished scenario up to its current target in one batch
+            tasks = []
+            for scenario, target in targets.items():
+                tasks += make_tasks(
+                    config,
+                    [scenario],
+                    base_seed,
+                    target,
+                    len(runs[scenario]),
+                    common_random_numbers,
+                )
+            for row in map_tasks(tasks, executor, cache=cache):
+                runs[(row["Receptionists"], row["Nurses"])].append(row)
+            # Stop the scenarios that converged and set new targets for the rest
+            next_targets = {}
+            for scenario in targets:
+                stats = replication_stats(runs[scenario], confidence)
+                needed = min(
+                    replications_needed(stats, rel_precision, stop_metrics),
+                    max_replications,
+                )
+                if needed > len(runs[scenario]):
+                    next_targets[scenario] = needed
+                else:
+                    yield stats, runs[scenario]
+            targets = next_targets
+
+
+def log_replication_summary(stats, confidence=0.95):
+    # Write the replication statistics of one scenario to the summary log
+    logger.info(
+        f"{stats['Receptionists']} Receptionists | {stats['Nurses']} Nurses | "
+        + f"{stats['Replications']} replications"
+    )
+    logger.info("===========================================================")
+    for metric in REPLICATION_METRICS:
+        logger.info(
+            f"{metric}: mean {stats[f'{metric} Mean']:.2f}, "
+            + f"SD {stats[f'{metric} SD']:.2f}, {int(confidence * 100)}% CI "
+            + f"[{stats[f'{metric} CI Low']:.2f}, {stats[f'{metric} CI High']:.2f}]"
+        )
+    logger.info("\n")
+
+
+# Version of the model's behaviour, part of every result cache key. Bump it
+# whenever a change to the model changes the results of a run.
+MODEL_VERSION = 2
+REPRODUCIBLE = True  # Use same random seeding if reproducible is true
+# BASE_SEED, NUM_WORKERS and the cache settings are shared by optimizer.py,
+# network.py, benchmark.py and service.py
+BASE_SEED = 1112  # Seed each run's seed is derived from when reproducible
+COMMON_RANDOM_NUMBERS = False  # Share random streams across staffing levels
+MIN_REPLICATIONS = 1  # Replications of each scenario before checking the CI
+MAX_REPLICATIONS = 1  # Cap on replications per scenario, 1 for single runs
+CI_LEVEL = 0.95  # Confidence level of the replication intervals
+CI_REL_PRECISION = 0.02  # Stop once the CI half-width is under 2% of the mean
+STOP_METRICS = ("Vaccinated",)  # Metrics the stopping rule checks
+NUM_WORKERS = None  # Worker processes, None for one per CPU
+LOG_LEVEL = "INFO"  # "TRACE" logs every patient event, "INFO" only summaries
+TRACE_BUFFER_BYTES = 1 << 20  # Write buffer of the trace log file
+OUTPUT_DIR = None  # Stream every run's records to Parquet here, None to skip
+PROFILE = False  # Write per-run timings and a flame graph profile of the sweep
+ARRIVAL_PROFILE = None  # Walk-in profile file, e.g. "arrival_profile.csv"
+APPOINTMENT_BOOK = None  # Appointment book file, None for appointment_freq
+CACHE_PATH = "result_cache.sqlite"  # Reuse earlier runs' results, None to rerun
+CACHE_MAX_BYTES = 64 << 20  # Evict the least recently used results past this
+PRESCREEN = False  # Skip scenarios the queueing approximations rule out
+PRESCREEN_MIN_VACCINATED_PCT = 25  # Prune below this predicted vaccinated pct
+PRESCREEN_MIN_UTILIZATION = 0.25  # Prune if either staff is predicted this idle
+SUMMARY_COLUMNS = ["Nurses", "Receptionists", "Balkers", "Renegers", "Vaccinated"]
+REPLICATION_METRICS = [
+    "Vaccinated",
+    "Balkers",
+    "Renegers",
+    "Nurse Free Time",
+    "Receptionist Free Time",
+]
+if __name__ == "__main__":
+    # Use the default clinic parameters for every scenario
+    config = ClinicConfig(
+        arrival_profile=ARRIVAL_PROFILE,
+        appointment_book=APPOINTMENT_BOOK,
+        trace=LOG_LEVEL == "TRACE",
+        output_dir=OUTPUT_DIR,
+        profile=PROFILE,
+    )
+    # Set up the logging
+    logger.remove()
+    logger.add(sys.stderr, format="{message}", level=LOG_LEVEL)
+    if LOG_LEVEL == "TRACE":
+        # Buffer the trace file and write it from a background queue so the
+        # simulation processes don't block on every line
+        logger.add(
+            f"Vaccine_Clinic_{config.sim_hrs} Hrs -{int(config.appointment_freq/60)} min Appts.log",
+            level="TRACE",
+            format="{message}",
+            buffering=TRACE_BUFFER_BYTES,
+            enqueue=True,
+        )
+    logger.add("Summary_Output.log", level="INFO", format="{message}")
+    num_workers = NUM_WORKERS
+    if LOG_LEVEL == "TRACE":
+        # The trace file sink only exists in this process: workers started
+        # by spawn or forkserver wouldn't have it and would drop their lines
+        num_workers = 1
+        logger.info("Tracing, so the sweep runs in this process")
+    # Use the fixed base seed if reproducible set to true, otherwise draw one
+    if REPRODUCIBLE:
+        base_seed = BASE_SEED
+    else:
+        base_seed = np.random.SeedSequence().entropy
+    scenarios = []
+    for i in range(1, 11):
+        for j in range(1, 11):
+            scenarios.append([i, j])
+    if PRESCREEN:
+        # Evaluate the whole grid analytically and only simulate the scenarios
+        # that could be worth running
+        scenarios, predictions = screen_scenarios(
+            config, scenarios, PRESCREEN_MIN_VACCINATED_PCT, PRESCREEN_MIN_UTILIZATION
+        )
+        predictions.to_excel("analytical_screen.xlsx", index=False)
+        logger.info(
+            f"Analytical screen kept {len(scenarios)} of {len(predictions)} scenarios."
+        )
+
+    if CACHE_PATH is not None:
+        cache = ResultCache(CACHE_PATH, MODEL_VERSION, CACHE_MAX_BYTES)
+    else:
+        cache = None
+    tic = time.perf_counter()
+    summary_rows = []
+    replication_rows = []
+    # Fan the scenarios out across worker processes and log each summary
+    # as it comes back
+    for stats, rows in run_replications(
+        config,
+        scenarios,
+        base_seed,
+        MIN_REPLICATIONS,
+        MAX_REPLICATIONS,
+        CI_LEVEL,
+        CI_REL_PRECISION,
+        STOP_METRICS,
+        num_workers,
+        COMMON_RANDOM_NUMBERS,
+        cache,
+    ):
+        for row in rows:
+            log_scenario_summary(row)
+            summary_rows.append(row)
+        if MAX_REPLICATIONS > 1:
+            log_replication_summary(stats, CI_LEVEL)
+            replication_rows.append(stats)
+    toc = time.perf_counter()
+    ic(f"{toc-tic} seconds have passed.")
+    if cache is not None:
+        logger.info(f"Reused {cache.hits} cached runs and simulated {cache.misses}.")
+        cache.close()
+    if MAX_REPLICATIONS > 1:
+        # Keep each run's replication number next to its results
+        summary_runs_df = pd.DataFrame(
+            summary_rows, columns=SUMMARY_COLUMNS + ["Replication"]
+        )
+        pd.DataFrame(replication_rows).to_excel(
+            "summary_replications.xlsx", index=False
+        )
+    else:
+        summary_runs_df = pd.DataFrame(summary_rows, columns=SUMMARY_COLUMNS)
+    summary_runs_df.to_excel("summary_runs.xlsx", index=False)
+    # Every run's full row, with the utilization, queue and wait statistics
+    pd.DataFrame(summary_rows).drop(
+        columns=["Profile Stacks"], errors="ignore"
+    ).to_excel("summary_statistics.xlsx", index=False)
+    if OUTPUT_DIR is not None:
+        export_excel_summary(OUTPUT_DIR, "output_summary.xlsx")
+    if PROFILE:
+        # Merge every run's stacks into one flame graph profile and write the
+        # per-run timings next to the summary
+        stacks = Counter()
+        for row in summary_rows:
+            stacks.update(row.pop("Profile Stacks"))
+        write_collapsed_stacks(stacks, "profile.collapsed")
+        pd.DataFrame(summary_rows).to_excel("profile_timings.xlsx", index=False)
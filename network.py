@@ -0,0 +1,293 @@
+import sys
+import time
+from collections import Counter
+from dataclasses import dataclass, replace
+from functools import partial
+
+import numpy as np
+import pandas as pd
+import simpy
+from loguru import logger
+
+from main import (
+    BASE_SEED,
+    NUM_WORKERS,
+    ClinicConfig,
+    Patient,
+    VaccineClinic,
+    VariateStream,
+    map_tasks,
+    open_executor,
+    summarize_clinic,
+)
+
+DAY_SECS = 24 * 60 * 60
+
+
+@dataclass(frozen=True)
+class NetworkConfig(object):
+    # Every parameter of one run of a network of clinic sites over several
+    # days. Each site is described by its own ClinicConfig, whose seed is
+    # ignored: every site and day gets a seed derived from the network's.
+    sites: tuple = (ClinicConfig(),)
+    days: int = 7
+    seed: int = None  # Seed of the run's random streams, None for fresh entropy
+    return_pct: float = 50  # Percent of walk-ins who left unvaccinated that return
+    max_return_days: int = 2  # Returning patients come back within this many days
+    route_returns: bool = True  # Send returning patients to the least busy site
+    share_nurses: bool = True  # Move idle nurses to the busiest site
+    nurse_travel_time: float = 20 * 60  # Seconds a nurse takes to change sites
+    update_interval: float = 10 * 60  # Seconds between routing and staff updates
+
+    @property
+    def shares_state(self):
+        # Whether the sites affect each other, so have to run in one environment
+        return len(self.sites) > 1 and (self.route_returns or self.share_nurses)
+
+
+def site_day_seed(seed, site, day):
+    # Derive an independent seed for one site on one day from the network seed
+    seed_seq = np.random.SeedSequence([seed, site, day])
+    return int(seed_seq.generate_state(1)[0])
+
+
+class ClinicNetwork(object):
+    # Runs every site of the network inside one simpy.Environment. Each site
+    # opens a fresh VaccineClinic every day, so a patient event only touches
+    # its own clinic. The work that spans sites (routing returning patients
+    # and moving nurses) runs once per update interval, so the cost per event
+    # stays flat as sites and days are added.
+    def __init__(self, env, config, sites=None):
+        """
+        env {simpy.Environment}: Environment every site runs in
+        config {NetworkConfig}: Sites and settings of the network
+        sites {list}: Indices of the sites to run, None for all of them. Sites
+            that don't share state can be run apart and give the same results.
+        """
+        if any(site.sim_hrs > 24 for site in config.sites):
+            raise ValueError("Clinic sites can be open at most 24 hours a day")
+        if config.seed is None:
+            # Fix the seed now so every site and day is derived from the same one
+            config = replace(
+                config, seed=int(np.random.SeedSequence().generate_state(1)[0])
+            )
+        self.env = env
+        self.config = config
+        self.sites = list(range(len(config.sites)) if sites is None else sites)
+        # Each site draws whether, when and where its patients come back from
+        # its own stream
+        self.return_streams = {
+            site: VariateStream(np.random.SeedSequence([config.seed, site]), "uniform")
+            for site in self.sites
+        }
+        # Today's clinic of every site, and every site's clinic of each day
+        self.clinics = {}
+        self.site_days = []
+        # Site returning patients are sent to, updated every interval
+        self.preferred_site = self.sites[0]
+        # Returning patients and nurse moves in and out by (site, day)
+        self.returning = Counter()
+        self.nurses_in = Counter()
+        self.nurses_out = Counter()
+
+    def run_days(self):
+        # Open every site at the start of each day
+        for day in range(self.config.days):
+            self.clinics = {site: self.open_site(site, day) for site in self.sites}
+            self.site_days.append(self.clinics)
+            if self.config.shares_state and len(self.sites) > 1:
+                self.env.process(self.update_sites(day))
+            yield self.env.timeout(DAY_SECS)
+
+    def open_site(self, site, day):
+        # Start one site's clinic for the day with its own seed
+        config = replace(
+            self.config.sites[site], seed=site_day_seed(self.config.seed, site, day)
+        )
+        clinic = VaccineClinic(self.env, config)
+        clinic.on_leave = partial(self.patient_left, site)
+        self.env.process(clinic.scheduled_arrivals())
+        self.env.process(clinic.arrive())
+        return clinic
+
+    def patient_left(self, site, patient):
+        # Walk-ins who left unvaccinated may come back on a later day
+        if patient.scheduled:
+            return
+        stream = self.return_streams[site]
+        if stream.next() >= self.config.return_pct / 100:
+            return
+        day = int(self.env.now // DAY_SECS) + 1
+        day += int(stream.next() * self.config.max_return_days)
+        if day >= self.config.days:
+            return
+        # Come back at a random time while the home site is open that day
+        arrival_time = (
+            day * DAY_SECS + stream.next() * self.config.sites[site].sim_secs
+        )
+        self.env.process(self.return_visit(site, patient, day, arrival_time))
+
+    def return_visit(self, site, patient, day, arrival_time):
+        yield self.env.timeout(arrival_time - self.env.now)
+        if self.config.route_returns:
+            site = self.preferred_site
+        clinic = self.clinics[site]
+        self.returning[site, day] += 1
+        # The patient keeps their type and patience, but is a new walk-in of
+        # the clinic they come back to
+        clinic.num_walk_ins += 1
+        returning_patient = clinic.add_patient(
+            Patient(
+                clinic.num_walk_ins,
+                False,
+                patient.patient_type,
+                patient.balk_max,
+                patient.renege_max,
+                self.env.now,
+            )
+        )
+        clinic.walk_in(returning_patient, self.env.now)
+
+    def update_sites(self, day):
+        # While the sites are open, route returning patients to the site
+        # with the shortest check in queue per receptionist and move nurses
+        # toward the longest vaccination queues
+        closing_time = day * DAY_SECS + max(
+            self.config.sites[site].sim_secs for site in self.sites
+        )
+        while self.env.now < closing_time:
+            clinics = self.clinics
+            self.preferred_site = min(
+                self.sites,
+                key=lambda site: len(clinics[site].check_in_queue)
+                / clinics[site].receptionist.capacity,
+            )
+            if (
+                self.config.share_nurses
+                and self.env.now + self.config.nurse_travel_time < closing_time
+            ):
+                self.move_nurse(day)
+            yield self.env.timeout(self.config.update_interval)
+
+    def move_nurse(self, day):
+        # Move one idle nurse from the site with the least vaccination queue
+        # per nurse to the site with the most, if that site has more than one
+        # patient waiting per nurse
+        clinics = self.clinics
+
+        def pressure(site):
+            nurse = clinics[site].nurse
+            return len(nurse.put_queue) / nurse.capacity
+
+        receiver = max(self.sites, key=pressure)
+        receiving_nurse = clinics[receiver].nurse
+        if len(receiving_nurse.put_queue) <= receiving_nurse.capacity:
+            return
+        donors = [
+            site
+            for site in self.sites
+            if site != receiver
+            and clinics[site].nurse.capacity > 1
+            and len(clinics[site].nurse.users) < clinics[site].nurse.capacity
+        ]
+        if not donors:
+            return
+        donor = min(donors, key=pressure)
+        donating_nurse = clinics[donor].nurse
+        donating_nurse.set_capacity(donating_nurse.capacity - 1)
+        self.nurses_out[donor, day] += 1
+        self.env.process(self.nurse_arrives(receiver, day))
+
+    def nurse_arrives(self, site, day):
+        yield self.env.timeout(self.config.nurse_travel_time)
+        nurse = self.site_days[day][site].nurse
+        nurse.set_capacity(nurse.capacity + 1)
+        self.nurses_in[site, day] += 1
+
+    def summary_rows(self):
+        # One summary row per site per day
+        rows = []
+        for day, clinics in enumerate(self.site_days):
+            for site, clinic in clinics.items():
+                row = {"Site": site, "Day": day + 1}
+                row.update(summarize_clinic(clinic))
+                row["Returning"] = self.returning[site, day]
+                row["Nurses In"] = self.nurses_in[site, day]
+                row["Nurses Out"] = self.nurses_out[site, day]
+                rows.append(row)
+        return rows
+
+
+def simulate_network(task):
+    # Worker entry point: run the given sites of a network and send back
+    # their summary rows
+    config, sites = task
+    env = simpy.Environment()
+    network = ClinicNetwork(env, config, sites)
+    env.process(network.run_days())
+    env.run()
+    for clinics in network.site_days:
+        for clinic in clinics.values():
+            clinic.finalize_records()
+    return network.summary_rows()
+
+
+def run_network(config, max_workers=None):
+    """
+    config {NetworkConfig}: Sites and settings of the network
+    max_workers {int}: Worker processes, None for one per CPU, 1 to run in-process
+
+    Returns a DataFrame with one summary row per site per day. Sites that
+    don't share nurses or returning patients are run in separate processes.
+    """
+    if config.seed is None:
+        config = replace(
+            config, seed=int(np.random.SeedSequence().generate_state(1)[0])
+        )
+    if config.shares_state:
+        tasks = [(config, None)]
+    else:
+        tasks = [(config, [site]) for site in range(len(config.sites))]
+    with open_executor(1 if len(tasks) == 1 else max_workers) as executor:
+        results = map_tasks(tasks, executor, simulate_network)
+        rows = [row for result in results for row in result]
+    rows.sort(key=lambda row: (row["Day"], row["Site"]))
+    return pd.DataFrame(rows)
+
+
+def log_network_summary(results):
+    # Write each site's totals over the whole run to the log
+    totals = results.groupby("Site")[
+        ["Vaccinated", "Balkers", "Renegers", "Returning", "Nurses In", "Nurses Out"]
+    ].sum()
+    for site, row in totals.iterrows():
+        patients = row["Vaccinated"] + row["Balkers"] + row["Renegers"]
+        logger.info(
+            f"Site {site}: {row['Vaccinated']} vaccinated "
+            + f"({row['Vaccinated'] / patients * 100:.1f}%), "
+            + f"{row['Balkers']} balked, {row['Renegers']} reneged, "
+            + f"{row['Returning']} returning patients, "
+            + f"{row['Nurses In']} nurses in, {row['Nurses Out']} out"
+        )
+
+
+SITES = (
+    ClinicConfig(num_receptionists=3, num_nurses=6),
+    ClinicConfig(num_receptionists=2, num_nurses=4, rushed_pct=40),
+    ClinicConfig(num_receptionists=2, num_nurses=8, low_flow_rate=1.0),
+)
+DAYS = 7
+if __name__ == "__main__":
+    logger.remove()
+    logger.add(sys.stderr, format="{message}", level="INFO")
+    logger.add("Network_Output.log", level="INFO", format="{message}")
+    tic = time.perf_counter()
+    results = run_network(
+        NetworkConfig(sites=SITES, days=DAYS, seed=BASE_SEED), NUM_WORKERS
+    )
+    toc = time.perf_counter()
+    log_network_summary(results)
+    logger.info(
+        f"Simulated {len(SITES)} sites for {DAYS} days in {toc-tic} seconds."
+    )
+    results.to_excel("network_results.xlsx", index=False)
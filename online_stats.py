@@ -0,0 +1,139 @@
+from math import ceil, log
+
+# Quantiles SampleStats tracks unless told otherwise
+DEFAULT_QUANTILES = (0.5, 0.9)
+
+
+class QuantileSketch(object):
+    # Quantiles of a stream of non-negative observations to within a set
+    # relative accuracy, whatever order they come in. Observations are
+    # counted in logarithmic buckets (as in DDSketch), so each one takes O(1)
+    # time and memory only grows with the log of their range.
+    def __init__(self, relative_accuracy=0.01):
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = log(self.gamma)
+        self.buckets = {}
+        self.zeros = 0
+        self.count = 0
+
+    def add(self, x):
+        self.count += 1
+        if x <= 0:
+            self.zeros += 1
+            return
+        key = ceil(log(x) / self.log_gamma)
+        self.buckets[key] = self.buckets.get(key, 0) + 1
+
+    def quantile(self, p):
+        if not self.count:
+            return float("nan")
+        rank = p * (self.count - 1)
+        seen = self.zeros
+        if rank < seen:
+            return 0.0
+        for key in sorted(self.buckets):
+            seen += self.buckets[key]
+            if seen > rank:
+                # Middle of the bucket, within the relative accuracy of
+                # everything in it
+                return 2 * self.gamma**key / (self.gamma + 1)
+        return 2 * self.gamma ** max(self.buckets) / (self.gamma + 1)
+
+
+class SampleStats(object):
+    # Running count, mean, variance (Welford's method), maximum and sketched
+    # quantiles of a stream of non-negative observations, e.g. wait times
+    def __init__(self, quantiles=DEFAULT_QUANTILES, relative_accuracy=0.01):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.max = float("nan")
+        self.quantiles = quantiles
+        self.sketch = QuantileSketch(relative_accuracy)
+
+    def add(self, x):
+        self.count += 1
+        delta = x - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (x - self.mean)
+        if not x <= self.max:
+            self.max = x
+        self.sketch.add(x)
+
+    def variance(self):
+        return self.m2 / (self.count - 1) if self.count > 1 else 0.0
+
+    def summary(self, name):
+        row = {
+            f"{name} Mean": self.mean if self.count else float("nan"),
+            f"{name} SD": self.variance() ** 0.5,
+            f"{name} Max": self.max,
+        }
+        for p in self.quantiles:
+            row[f"{name} P{round(p * 100)}"] = self.sketch.quantile(p)
+        return row
+
+
+class TimeWeightedStats(object):
+    # Time-weighted statistics of an integer level that changes over time,
+    # e.g. a queue length. It keeps how long the level spent at each value,
+    # so the mean, variance and quantiles over time are exact, each change
+    # takes O(1) time, and memory only grows with the largest level seen.
+    def __init__(self, start_time=0):
+        self.last_time = start_time
+        self.level = 0
+        self.max = 0
+        self.durations = [0.0]
+
+    def update(self, time, level):
+        # Record that the level changed to the given value at the given time
+        self.durations[self.level] += time - self.last_time
+        self.last_time = time
+        self.level = level
+        if level > self.max:
+            self.max = level
+            self.durations.extend([0.0] * (level + 1 - len(self.durations)))
+
+    def close(self, time):
+        # Count the current level up to the given time, e.g. closing time
+        if time > self.last_time:
+            self.update(time, self.level)
+
+    def mean(self):
+        total = sum(self.durations)
+        if not total:
+            return 0.0
+        return sum(level * time for level, time in enumerate(self.durations)) / total
+
+    def variance(self):
+        total = sum(self.durations)
+        if not total:
+            return 0.0
+        mean = self.mean()
+        return (
+            sum(
+                (level - mean) ** 2 * time for level, time in enumerate(self.durations)
+            )
+            / total
+        )
+
+    def quantile(self, p):
+        # Smallest level the clinic spent at least a fraction p of the time at
+        # or below
+        total = sum(self.durations)
+        cumulative = 0.0
+        for level, time in enumerate(self.durations):
+            cumulative += time
+            if cumulative >= p * total:
+                return level
+        return self.max
+
+    def summary(self, name, quantiles=DEFAULT_QUANTILES):
+        row = {
+            f"{name} Mean": self.mean(),
+            f"{name} SD": self.variance() ** 0.5,
+            f"{name} Max": self.max,
+        }
+        for p in quantiles:
+            row[f"{name} P{round(p * 100)}"] = self.quantile(p)
+        return row
@@ -0,0 +1,229 @@
+import sys
+import time
+from dataclasses import replace
+
+import numpy as np
+import pandas as pd
+from loguru import logger
+
+from cache import ResultCache
+from main import (
+    BASE_SEED,
+    CACHE_MAX_BYTES,
+    CACHE_PATH,
+    MODEL_VERSION,
+    NUM_WORKERS,
+    REPLICATION_METRICS,
+    ClinicConfig,
+    map_tasks,
+    open_executor,
+    replication_stats,
+    scenario_seed,
+)
+
+# Metrics that make up the objective: each run's score is the weighted sum of
+# these, and lower scores are better
+OBJECTIVE_METRICS = REPLICATION_METRICS + ["Vaccinated Pct"]
+
+
+def vaccinated_pct(row):
+    # Percent of the patients who came to the clinic that were vaccinated
+    total = row["Vaccinated"] + row["Balkers"] + row["Renegers"]
+    return row["Vaccinated"] / total * 100 if total else 0.0
+
+
+def score_run(row, weights):
+    # Add the vaccinated percentage and the weighted objective to a run's row
+    row["Vaccinated Pct"] = vaccinated_pct(row)
+    row["Score"] = sum(weight * row[metric] for metric, weight in weights.items())
+    return row
+
+
+def constraint_violation(stats, constraints):
+    # How far the mean metrics of a candidate are outside their
+    # (minimum, maximum) bounds, 0 when every constraint holds
+    violation = 0.0
+    for metric, (minimum, maximum) in constraints.items():
+        mean = stats[f"{metric} Mean"]
+        if minimum is not None and mean < minimum:
+            violation += minimum - mean
+        if maximum is not None and mean > maximum:
+            violation += mean - maximum
+    return violation
+
+
+def rank_candidates(runs, candidates, confidence, constraints):
+    # Summarize every candidate's runs and order them best first: feasible
+    # candidates by mean score, then infeasible ones by how far off they are
+    ranking = []
+    for candidate in candidates:
+        stats = replication_stats(
+            runs[candidate], confidence, OBJECTIVE_METRICS + ["Score"]
+        )
+        stats["Appointment Freq"] = candidate.appointment_freq
+        stats["Violation"] = constraint_violation(stats, constraints)
+        stats["Feasible"] = stats["Violation"] == 0
+        ranking.append((candidate, stats))
+    ranking.sort(key=lambda item: (item[1]["Violation"], item[1]["Score Mean"]))
+    return ranking
+
+
+def make_candidates(config, receptionist_range, nurse_range, appointment_freqs):
+    # One config per staffing level and appointment frequency to search over
+    return [
+        replace(
+            config,
+            num_receptionists=num_receptionists,
+            num_nurses=num_nurses,
+            appointment_freq=appointment_freq,
+        )
+        for appointment_freq in appointment_freqs
+        for num_receptionists in receptionist_range
+        for num_nurses in nurse_range
+    ]
+
+
+def successive_halving(
+    candidates,
+    base_seed,
+    weights,
+    constraints=None,
+    min_replications=2,
+    max_replications=32,
+    eta=2,
+    confidence=0.95,
+    max_workers=None,
+    common_random_numbers=True,
+    cache=None,
+):
+    """
+    candidates {list}: ClinicConfigs to choose between
+    base_seed {int}: Seed every run's seed is derived from
+    weights {dict}: Objective weight of each metric in OBJECTIVE_METRICS,
+        negative for metrics that should be high
+    constraints {dict}: (minimum, maximum) bounds on mean metrics, None for no bound
+    min_replications {int}: Replications every candidate gets in the first round
+    max_replications {int}: Replications the final candidates are compared on
+    eta {int}: Each round keeps 1/eta of the candidates and runs eta times
+        as many replications
+    confidence {float}: Confidence level used to spot clearly worse candidates
+    max_workers {int}: Worker processes, None for one per CPU, 1 to run in-process
+    common_random_numbers {bool}: Give every candidate the same seeds
+    cache {ResultCache}: Cache of earlier runs' rows, None to run everything
+
+    Yields (round number, ranking) after every round, where ranking is a list
+    of (candidate, stats) pairs best first. The last ranking is the answer.
+    """
+    constraints = constraints or {}
+    runs = {candidate: [] for candidate in candidates}
+    survivors = list(candidates)
+    replications = min(min_replications, max_replications)
+    round_number = 0
+    with open_executor(max_workers) as executor:
+        while True:
+            # Bring every surviving candidate up to this round's replications,
+            # keeping each task paired with the candidate it belongs to
+            pairs = [
+                (
+                    candidate,
+                    (
+                        replace(
+                            candidate,
+                            seed=scenario_seed(
+                                base_seed,
+                                candidate.num_receptionists,
+                                candidate.num_nurses,
+                                replication,
+                                common_random_numbers,
+                            ),
+                        ),
+                        replication,
+                    ),
+                )
+                for candidate in survivors
+                for replication in range(len(runs[candidate]), replications)
+            ]
+            rows = map_tasks([task for _, task in pairs], executor, cache=cache)
+            for (candidate, _), row in zip(pairs, rows):
+                runs[candidate].append(score_run(row, weights))
+            ranking = rank_candidates(runs, survivors, confidence, constraints)
+            yield round_number, ranking
+            if len(ranking) == 1 or replications >= max_replications:
+                return
+            # Drop candidates whose score interval lies wholly above the
+            # best's, then keep at most the top 1/eta of the rest
+            best_high = ranking[0][1]["Score CI High"]
+            keep = max(1, int(np.ceil(len(ranking) / eta)))
+            survivors = [
+                candidate
+                for candidate, stats in ranking
+                if not stats["Score CI Low"] > best_high
+            ][:keep]
+            replications = min(replications * eta, max_replications)
+            round_number += 1
+
+
+def log_round(round_number, ranking, top=5):
+    # Write the leaders of one optimizer round to the log
+    logger.info(
+        f"Round {round_number}: {len(ranking)} candidates at "
+        + f"{ranking[0][1]['Replications']} replications"
+    )
+    for candidate, stats in ranking[:top]:
+        logger.info(
+            f"{candidate.num_receptionists} Receptionists | "
+            + f"{candidate.num_nurses} Nurses | "
+            + f"{int(candidate.appointment_freq/60)} min Appts: "
+            + f"score {stats['Score Mean']:.2f} "
+            + f"[{stats['Score CI Low']:.2f}, {stats['Score CI High']:.2f}], "
+            + f"{stats['Vaccinated Pct Mean']:.1f}% vaccinated"
+            + ("" if stats["Feasible"] else " (infeasible)")
+        )
+
+
+RECEPTIONIST_RANGE = range(1, 16)
+NURSE_RANGE = range(1, 16)
+APPOINTMENT_FREQS = [10 * 60, 15 * 60, 20 * 60, 30 * 60]
+# Lower is better: reward vaccinated percentage, penalize patients lost and
+# staff sitting idle (one lost patient costs as much as 10 idle staff minutes)
+OBJECTIVE_WEIGHTS = {
+    "Vaccinated Pct": -10.0,
+    "Balkers": 1.0,
+    "Renegers": 1.0,
+    "Nurse Free Time": 1 / 600,
+    "Receptionist Free Time": 1 / 600,
+}
+CONSTRAINTS = {"Vaccinated Pct": (90, None)}  # Vaccinate at least 90 percent
+MIN_REPLICATIONS = 2
+MAX_REPLICATIONS = 32
+ETA = 2  # Keep half the candidates each round
+CI_LEVEL = 0.95
+if __name__ == "__main__":
+    logger.remove()
+    logger.add(sys.stderr, format="{message}", level="INFO")
+    logger.add("Optimizer_Output.log", level="INFO", format="{message}")
+    candidates = make_candidates(
+        ClinicConfig(), RECEPTIONIST_RANGE, NURSE_RANGE, APPOINTMENT_FREQS
+    )
+    cache = None
+    if CACHE_PATH is not None:
+        cache = ResultCache(CACHE_PATH, MODEL_VERSION, CACHE_MAX_BYTES)
+    tic = time.perf_counter()
+    for round_number, ranking in successive_halving(
+        candidates,
+        BASE_SEED,
+        OBJECTIVE_WEIGHTS,
+        CONSTRAINTS,
+        MIN_REPLICATIONS,
+        MAX_REPLICATIONS,
+        ETA,
+        CI_LEVEL,
+        NUM_WORKERS,
+        cache=cache,
+    ):
+        log_round(round_number, ranking)
+    toc = time.perf_counter()
+    logger.info(f"Searched {len(candidates)} candidates in {toc-tic} seconds.")
+    pd.DataFrame([stats for _, stats in ranking]).to_excel(
+        "optimizer_results.xlsx", index=False
+    )
@@ -0,0 +1,186 @@
+import signal
+import sys
+import time
+from collections import Counter
+
+import simpy
+from loguru import logger
+
+# Stack sampling runs on SIGPROF interval timers, which only POSIX has
+SAMPLES_STACKS = hasattr(signal, "setitimer")
+
+
+class CountingEnvironment(simpy.Environment):
+    # SimPy environment that counts the events it processes
+    def __init__(self, initial_time=0):
+        super().__init__(initial_time)
+        self.events_processed = 0
+
+    def step(self):
+        super().step()
+        self.events_processed += 1
+
+
+class ProfilingEnvironment(CountingEnvironment):
+    # Counting environment that also samples the size of the clinic's record
+    # structures every sample_every events
+    def __init__(self, profiler, sample_every=1000):
+        super().__init__()
+        self.profiler = profiler
+        self.sample_every = sample_every
+
+    def step(self):
+        super().step()
+        if self.events_processed % self.sample_every == 0:
+            self.profiler.sample_memory()
+
+
+class MethodTimer(object):
+    # Accumulated wall time and call count of one clinic method
+    def __init__(self):
+        self.seconds = 0.0
+        self.calls = 0
+
+
+def record_bytes(clinic):
+    # Bytes held by the clinic's record stores and queue length lists (only
+    # kept with queue traces)
+    size = 0
+    for store in (clinic.patient_records, clinic.event_records):
+        size += sum(column.nbytes for column in store.columns.values())
+    for lengths in (clinic.check_in_queue_length, clinic.vaccination_queue_length):
+        if lengths is not None:
+            size += sys.getsizeof(lengths)
+    return size
+
+
+class RunProfiler(object):
+    # Opt-in profiler for one clinic run. It times the clinic's hot methods
+    # (inclusive of what they call), counts SimPy events, samples how the
+    # record structures grow, and samples the Python stack on a CPU timer to
+    # build collapsed stacks that flame graph tools (flamegraph.pl, speedscope)
+    # read directly, where the platform has SIGPROF timers.
+    PROCESS_METHODS = ["arrive", "scheduled_arrivals", "check_in", "vaccinate"]
+    PLAIN_METHODS = ["add_to_event_log", "grab_renege_and_check_in_times"]
+    warned = False  # Whether this process logged that stacks aren't sampled
+
+    def __init__(self, sample_every=1000, stack_interval=0.001):
+        self.env = ProfilingEnvironment(self, sample_every)
+        self.stack_interval = stack_interval
+        self.timers = {
+            name: MethodTimer() for name in self.PROCESS_METHODS + self.PLAIN_METHODS
+        }
+        self.stacks = Counter()
+        self.memory_samples = []
+        self.clinic = None
+        self.wall_time = 0.0
+
+    def attach(self, clinic):
+        # Shadow the clinic's methods with timed versions on the instance, so
+        # processes the clinic starts itself are timed too
+        self.clinic = clinic
+        for name in self.PROCESS_METHODS:
+            setattr(clinic, name, self.time_process(getattr(clinic, name), name))
+        for name in self.PLAIN_METHODS:
+            setattr(clinic, name, self.time_method(getattr(clinic, name), name))
+
+    def time_method(self, method, name):
+        timer = self.timers[name]
+
+        def timed(*args, **kwargs):
+            tic = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                timer.seconds += time.perf_counter() - tic
+                timer.calls += 1
+
+        return timed
+
+    def time_process(self, method, name):
+        timer = self.timers[name]
+
+        def timed(*args, **kwargs):
+            timer.calls += 1
+            return self.timed_generator(method(*args, **kwargs), timer)
+
+        return timed
+
+    def timed_generator(self, generator, timer):
+        # Drive a process generator, timing each resume between yields and
+        # passing event values and exceptions through unchanged
+        value = None
+        error = None
+        while True:
+            tic = time.perf_counter()
+            try:
+                if error is None:
+                    event = generator.send(value)
+                else:
+                    event = generator.throw(error)
+            except StopIteration as stop:
+                return stop.value
+            finally:
+                timer.seconds += time.perf_counter() - tic
+            try:
+                value = yield event
+                error = None
+            except BaseException as thrown:
+                error = thrown
+
+    def sample_memory(self):
+        self.memory_samples.append((self.env.now, record_bytes(self.clinic)))
+
+    def sample_stack(self, signum, frame):
+        # Collapse the current stack into "outer;...;inner" and count it
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append(f"{code.co_name} ({code.co_filename}:{code.co_firstlineno})")
+            frame = frame.f_back
+        self.stacks[";".join(reversed(names))] += 1
+
+    def start(self):
+        self.tic = time.perf_counter()
+        if SAMPLES_STACKS:
+            signal.signal(signal.SIGPROF, self.sample_stack)
+            signal.setitimer(
+                signal.ITIMER_PROF, self.stack_interval, self.stack_interval
+            )
+        elif not RunProfiler.warned:
+            # Once per process, not once per run
+            RunProfiler.warned = True
+            logger.info(
+                "Stack sampling needs SIGPROF timers, which this platform lacks; "
+                + "only timing the clinic's methods"
+            )
+
+    def stop(self):
+        if SAMPLES_STACKS:
+            signal.setitimer(signal.ITIMER_PROF, 0)
+            signal.signal(signal.SIGPROF, signal.SIG_DFL)
+        self.wall_time = time.perf_counter() - self.tic
+        self.sample_memory()
+
+    def summary(self):
+        # One row of timings for the run's entry in the timing table
+        row = {
+            "Wall Time": self.wall_time,
+            "SimPy Events": self.env.events_processed,
+            "Events Per Sec": self.env.events_processed / self.wall_time
+            if self.wall_time
+            else 0.0,
+            "Record Bytes": self.memory_samples[-1][1],
+            "Record Bytes Max": max(size for _, size in self.memory_samples),
+        }
+        for name, timer in self.timers.items():
+            row[f"{name} Seconds"] = timer.seconds
+            row[f"{name} Calls"] = timer.calls
+        return row
+
+
+def write_collapsed_stacks(stacks, path):
+    # Write stack counts in the collapsed format flame graph tools read
+    with open(path, "w") as stack_file:
+        for stack, count in sorted(stacks.items()):
+            stack_file.write(f"{stack} {count}\n")
@@ -0,0 +1,226 @@
+from math import erf, exp, pi, sqrt
+
+import numpy as np
+import pandas as pd
+
+from arrivals import load_appointment_book, load_arrival_profile
+
+# Length of the check-in queue at which each kind of patient balks, matching
+# randomize_patient_type and scheduled_arrivals
+RUSHED_BALK_MAX = 5
+RELAXED_BALK_MAX = 15
+SCHEDULED_BALK_MAX = 20
+
+
+def folded_normal_moments(mean, sd):
+    # Mean and squared coefficient of variation of |X| for X ~ N(mean, sd),
+    # the distribution the model draws inter-arrival and service times from
+    ratio = mean / sd
+    phi = 0.5 * (1 + erf(-ratio / sqrt(2)))
+    first = sd * sqrt(2 / pi) * exp(-(ratio**2) / 2) + mean * (1 - 2 * phi)
+    second = mean**2 + sd**2
+    return first, second / first**2 - 1
+
+
+def flow_segments(config):
+    # (start, end, mins between walk-ins) of each time-of-day window used by
+    # VaccineClinic.create_patient_flow_rates, cut off at closing time
+    high, low = config.high_flow_rate, config.low_flow_rate
+    windows = [
+        (0, 7200, high),
+        (7200, 14400, low),
+        (14400, 25200, high),
+        (25200, 36000, low),
+        (36000, np.inf, high),
+    ]
+    return [
+        (start, min(end, config.sim_secs), rate)
+        for start, end, rate in windows
+        if start < config.sim_secs
+    ]
+
+
+def profile_segments(config):
+    # (start, end, walk-ins per second) of each row of the config's arrival
+    # profile, cut off at closing time
+    starts, rates = load_arrival_profile(config.arrival_profile)
+    ends = np.append(starts[1:], np.inf)
+    return [
+        (start, min(end, config.sim_secs), rate)
+        for start, end, rate in zip(starts, ends, rates)
+        if start < config.sim_secs and start < end
+    ]
+
+
+def arrival_rates(config):
+    # Segment durations and walk-in and appointment arrivals per second
+    if config.arrival_profile is None:
+        segments = flow_segments(config)
+        walk_in = np.array(
+            [
+                1 / (folded_normal_moments(rate, rate / 2)[0] * 60)
+                for _, _, rate in segments
+            ]
+        )
+    else:
+        segments = profile_segments(config)
+        walk_in = np.array([rate for _, _, rate in segments])
+    durations = np.array([end - start for start, end, _ in segments])
+    if config.appointment_book is None:
+        scheduled = np.full_like(walk_in, 1 / config.appointment_freq)
+    else:
+        # Spread each segment's booked appointments evenly over it
+        times = load_appointment_book(config.appointment_book)
+        bounds = np.array([start for start, _, _ in segments] + [segments[-1][1]])
+        scheduled = np.histogram(times, bounds)[0] / durations
+    return durations, walk_in, scheduled
+
+
+def check_in_station(walk_in, scheduled, receptionists, mu, rushed_fraction):
+    # Birth-death model of the check-in line, vectorized over segments (axis 0)
+    # and receptionist counts (axis 1). A patient joins if the line (waiting
+    # plus being checked in) is shorter than their balk length, so the arrival
+    # rate drops as the line passes 5, 15 and 20 patients. Returns the
+    # fraction of arrivals that balk, the mean line length, and utilization.
+    walk_in = walk_in[:, None]
+    scheduled = scheduled[:, None]
+    servers = np.asarray(receptionists)[None, :]
+    states = np.arange(SCHEDULED_BALK_MAX + 1)
+    weights = np.ones(walk_in.shape[:1] + servers.shape[1:] + states.shape)
+    join_rates = []
+    for n in states:
+        # Rate of patients joining a line of length n
+        walk_in_joining = np.where(
+            n < RUSHED_BALK_MAX,
+            1.0,
+            np.where(n < RELAXED_BALK_MAX, 1 - rushed_fraction, 0.0),
+        )
+        join_rates.append(
+            walk_in * walk_in_joining + scheduled * (n < SCHEDULED_BALK_MAX)
+        )
+        if n > 0:
+            # Balance: p(n) = p(n - 1) * join(n - 1) / (min(n, c) * mu)
+            weights[..., n] = (
+                weights[..., n - 1] * join_rates[n - 1] / (np.minimum(n, servers) * mu)
+            )
+    probabilities = weights / weights.sum(axis=-1, keepdims=True)
+    join_rates = np.stack(join_rates, axis=-1)
+    total_rate = walk_in + scheduled
+    # Arrivals see the time-average state (PASTA). Nobody balks while nobody
+    # arrives.
+    with np.errstate(divide="ignore", invalid="ignore"):
+        join_fraction = np.where(
+            total_rate > 0,
+            (probabilities * join_rates).sum(axis=-1) / total_rate,
+            1.0,
+        )
+    busy = (probabilities * np.minimum(states, servers[..., None])).sum(axis=-1)
+    mean_length = (probabilities * states).sum(axis=-1)
+    return 1 - join_fraction, mean_length, busy / servers
+
+
+def erlang_c(servers, offered_load):
+    # Probability an arrival waits in an M/M/c queue, via the Erlang B
+    # recursion, vectorized over any broadcastable servers and offered load
+    servers, offered_load = np.broadcast_arrays(servers, offered_load)
+    erlang_b = np.ones(offered_load.shape)
+    for k in range(1, int(servers.max()) + 1):
+        step = offered_load * erlang_b / (k + offered_load * erlang_b)
+        erlang_b = np.where(k <= servers, step, erlang_b)
+    rho = offered_load / servers
+    with np.errstate(divide="ignore", invalid="ignore"):
+        wait = erlang_b / (1 - rho * (1 - erlang_b))
+    return np.where(rho < 1, wait, 1.0)
+
+
+def predict_grid(config, receptionist_range, nurse_range):
+    # Analytical prediction for every (receptionists, nurses) pair and flow
+    # segment at once. Check-in is the birth-death balking model above; the
+    # vaccination line is an M/G/c queue fed by the patients who checked in,
+    # with the Allen-Cunneen approximation for its mean length. Returns one
+    # row per staffing pair with day-long, arrival-weighted predictions.
+    receptionists = np.array(list(receptionist_range))
+    nurses = np.array(list(nurse_range))
+    durations, walk_in, scheduled = arrival_rates(config)
+    check_in_mean, _ = folded_normal_moments(config.mean_check_in_time, 0.5)
+    vaccine_mean, vaccine_scv = folded_normal_moments(config.mean_vaccine_time, 1)
+    mu_check_in = 1 / (check_in_mean * 60)
+    mu_vaccine = 1 / (vaccine_mean * 60)
+
+    # Shape (segments, receptionists)
+    balk, check_in_length, receptionist_util = check_in_station(
+        walk_in, scheduled, receptionists, mu_check_in, config.rushed_pct / 100
+    )
+    # Shape (segments, receptionists, nurses)
+    vaccine_rate = ((walk_in + scheduled)[:, None] * (1 - balk))[..., None]
+    offered_load = vaccine_rate / mu_vaccine
+    servers = nurses[None, None, :]
+    rho = offered_load / servers
+    wait = erlang_c(servers, offered_load)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        vaccine_queue = np.where(
+            rho < 1, wait * rho / (1 - rho) * (1 + vaccine_scv) / 2, np.inf
+        )
+    # Nurses can vaccinate at most servers * mu, the rest renege
+    vaccinated_rate = np.minimum(vaccine_rate, servers * mu_vaccine)
+
+    arrivals = (walk_in + scheduled) * durations
+    time_weights = durations / durations.sum()
+    total_arrivals = arrivals.sum()
+    rows = []
+    for i, num_receptionists in enumerate(receptionists):
+        for j, num_nurses in enumerate(nurses):
+            vaccinated = (vaccinated_rate[:, i, j] * durations).sum()
+            balked = (balk[:, i] * arrivals).sum()
+            nurse_util = np.minimum(rho[:, i, j], 1)
+            rows.append(
+                {
+                    "Receptionists": int(num_receptionists),
+                    "Nurses": int(num_nurses),
+                    "Predicted Arrivals": total_arrivals,
+                    "Predicted Vaccinated Pct": vaccinated / total_arrivals * 100,
+                    "Predicted Balk Pct": balked / total_arrivals * 100,
+                    "Receptionist Utilization": receptionist_util[:, i] @ time_weights,
+                    "Nurse Utilization": nurse_util @ time_weights,
+                    "Check-In Queue Length": check_in_length[:, i] @ time_weights,
+                    "Vaccination Queue Length": vaccine_queue[:, i, j] @ time_weights,
+                    "Peak Nurse Load": rho[:, i, j].max(),
+                }
+            )
+    return pd.DataFrame(rows)
+
+
+def screen_scenarios(config, scenarios, min_vaccinated_pct, min_utilization):
+    """
+    config {ClinicConfig}: Clinic parameters shared by the scenarios
+    scenarios {list}: [num_receptionists, num_nurses] pairs to screen
+    min_vaccinated_pct {float}: Prune scenarios predicted to vaccinate less
+    min_utilization {float}: Prune scenarios whose receptionists or nurses
+        are predicted to be busy less than this fraction of the day
+
+    Returns the scenarios worth simulating, in their original order, and the
+    prediction table with a Pruned column.
+    """
+    receptionist_range = sorted({scenario[0] for scenario in scenarios})
+    nurse_range = sorted({scenario[1] for scenario in scenarios})
+    predictions = predict_grid(config, receptionist_range, nurse_range)
+    predictions["Pruned"] = (
+        (predictions["Predicted Vaccinated Pct"] < min_vaccinated_pct)
+        | (predictions["Receptionist Utilization"] < min_utilization)
+        | (predictions["Nurse Utilization"] < min_utilization)
+    )
+    pruned = set(
+        zip(
+            predictions.loc[predictions["Pruned"], "Receptionists"],
+            predictions.loc[predictions["Pruned"], "Nurses"],
+        )
+    )
+    kept = [scenario for scenario in scenarios if tuple(scenario) not in pruned]
+    wanted = {tuple(scenario) for scenario in scenarios}
+    predictions = predictions[
+        [
+            (row.Receptionists, row.Nurses) in wanted
+            for row in predictions.itertuples()
+        ]
+    ].reset_index(drop=True)
+    return kept, predictions
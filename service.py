@@ -0,0 +1,392 @@
+import argparse
+import asyncio
+import json
+import math
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import fields
+
+import simpy
+from loguru import logger
+
+from cache import ResultCache
+from main import (
+    BASE_SEED,
+    CACHE_MAX_BYTES,
+    CACHE_PATH,
+    MODEL_VERSION,
+    ClinicConfig,
+    make_tasks,
+    replication_stats,
+    run_scenario,
+    summarize_clinic,
+)
+
+# Config fields a request may not set: seeds are derived from the base seed,
+# tracing, profiling and file output are for batch runs, and input files
+# would let any client make the server open any path
+RESERVED_FIELDS = (
+    "seed",
+    "trace",
+    "output_dir",
+    "profile",
+    "queue_traces",
+    "arrival_profile",
+    "appointment_book",
+)
+CONFIG_FIELDS = {
+    field.name: field.type
+    for field in fields(ClinicConfig)
+    if field.name not in RESERVED_FIELDS
+}
+STAFF_FIELDS = ("num_receptionists", "num_nurses")
+MAX_SIM_HRS = 24  # Longest clinic day a request can simulate
+# Most walk-ins plus appointments a request's clinic day may expect, so tiny
+# flow rates or appointment gaps can't ask for billions of arrivals
+MAX_EXPECTED_ARRIVALS = 50_000
+MAX_BODY_BYTES = 1 << 16
+RUN_TIME_LIMIT = 60  # Wall clock seconds a single run may take
+
+
+def warm_worker():
+    # Worker initializer: the model is imported by the time this runs, and a
+    # short run fills the remaining lazy imports and caches before the first
+    # real request arrives
+    run_scenario(ClinicConfig(sim_hrs=0.25, seed=0))
+
+
+class DeadlineEnvironment(simpy.Environment):
+    # SimPy environment that gives up once a wall clock deadline passes, so a
+    # run that turns out far slower than expected frees its worker. The clock
+    # is checked every check_every events to keep the cost per event flat.
+    def __init__(self, deadline, check_every=1024):
+        super().__init__()
+        self.deadline = deadline
+        self.check_every = check_every
+        self.until_check = check_every
+
+    def step(self):
+        self.until_check -= 1
+        if not self.until_check:
+            self.until_check = self.check_every
+            if time.perf_counter() > self.deadline:
+                raise TimeoutError("Run passed the service's time limit")
+        super().step()
+
+
+def simulate_with_limit(task, time_limit):
+    # Worker entry point: run one (config, replication) task like
+    # simulate_scenario, but raise TimeoutError past time_limit seconds.
+    # Requests can't ask for Parquet output or profiling, so neither is set up.
+    config, replication = task
+    env = DeadlineEnvironment(time.perf_counter() + time_limit)
+    row = summarize_clinic(run_scenario(config, env=env))
+    row["Replication"] = replication
+    row["Seed"] = config.seed
+    return row
+
+
+def parse_request(request):
+    """
+    request {dict}: {"config": {ClinicConfig fields}, "replications": int,
+        "base_seed": int, "common_random_numbers": bool, "confidence": float},
+        where every key is optional
+
+    Returns the (config, replication) tasks and confidence level of the
+    request, or raises ValueError if it is malformed.
+    """
+    if not isinstance(request, dict):
+        raise ValueError("Request must be a JSON object")
+    unknown = set(request) - {
+        "config",
+        "replications",
+        "base_seed",
+        "common_random_numbers",
+        "confidence",
+    }
+    if unknown:
+        raise ValueError(f"Unknown request keys: {sorted(unknown)}")
+    overrides = request.get("config", {})
+    if not isinstance(overrides, dict):
+        raise ValueError("config must be a JSON object")
+    unknown = set(overrides) - set(CONFIG_FIELDS)
+    if unknown:
+        raise ValueError(f"Unknown or reserved config fields: {sorted(unknown)}")
+    for name, value in overrides.items():
+        check_field(name, value)
+    config = ClinicConfig(**overrides)
+    if expected_arrivals(config) > MAX_EXPECTED_ARRIVALS:
+        raise ValueError(
+            f"config expects over {MAX_EXPECTED_ARRIVALS} arrivals: raise the "
+            + "flow rates or appointment_freq, or lower sim_hrs"
+        )
+    # JSON true and false are bools, which are ints to Python
+    replications = request.get("replications", 1)
+    if not is_integer(replications) or not 1 <= replications <= 1000:
+        raise ValueError("replications must be an integer from 1 to 1000")
+    base_seed = request.get("base_seed", BASE_SEED)
+    if not is_integer(base_seed) or base_seed < 0:
+        raise ValueError("base_seed must be a non-negative integer")
+    confidence = request.get("confidence", 0.95)
+    if not is_number(confidence) or not 0 < confidence < 1:
+        raise ValueError("confidence must be between 0 and 1")
+    common_random_numbers = request.get("common_random_numbers", False)
+    if not isinstance(common_random_numbers, bool):
+        raise ValueError("common_random_numbers must be true or false")
+    tasks = make_tasks(
+        config,
+        [[config.num_receptionists, config.num_nurses]],
+        base_seed,
+        replications,
+        common_random_numbers=common_random_numbers,
+    )
+    return tasks, confidence
+
+
+def is_integer(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def expected_arrivals(config):
+    # Rough upper bound on a day's arrivals: walk-ins at the busier of the
+    # two flow rates (minutes between walk-ins) plus the appointments
+    walk_ins = config.sim_hrs * 60 / min(config.high_flow_rate, config.low_flow_rate)
+    return walk_ins + config.sim_secs / config.appointment_freq
+
+
+def check_field(name, value):
+    # Raise ValueError unless the value has the field's type and is in range.
+    # Staffing counts are integers of at least 1, rushed_pct a percentage,
+    # and every other field a positive number
+    if not is_number(value):
+        raise ValueError(f"{name} must be a number")
+    if CONFIG_FIELDS[name] is int and not is_integer(value):
+        raise ValueError(f"{name} must be an integer")
+    if name in STAFF_FIELDS and value < 1:
+        raise ValueError(f"{name} must be at least 1")
+    if not math.isfinite(value):
+        raise ValueError(f"{name} must be finite")
+    if name == "rushed_pct" and not 0 <= value <= 100:
+        raise ValueError(f"{name} must be from 0 to 100")
+    if name != "rushed_pct" and not value > 0:
+        raise ValueError(f"{name} must be positive")
+    if name == "sim_hrs" and value > MAX_SIM_HRS:
+        raise ValueError(f"{name} must be at most {MAX_SIM_HRS}")
+
+
+def json_line(kind, row):
+    # One NDJSON line, with NumPy scalars as plain numbers and NaN as null
+    values = {"type": kind}
+    for name, value in row.items():
+        if hasattr(value, "item"):
+            value = value.item()
+        if isinstance(value, float) and not math.isfinite(value):
+            value = None
+        values[name] = value
+    return (json.dumps(values) + "\n").encode()
+
+
+class SimulationService(object):
+    # Local HTTP service that runs staffing what-ifs on a warm process pool.
+    # POST /simulate takes a JSON request (see parse_request) and streams
+    # back NDJSON: one "replication" line per run as it finishes, then a
+    # "summary" line with the replication statistics. Runs are deduplicated
+    # by (config, replication): a request asking for a run that is already in
+    # flight waits on the same future instead of simulating it again.
+    def __init__(self, executor, cache=None, time_limit=RUN_TIME_LIMIT):
+        """
+        executor {ProcessPoolExecutor}: Warm pool the runs are sent to
+        cache {ResultCache}: Cache of earlier runs' rows, None to run everything
+        time_limit {float}: Wall clock seconds a run may take before it is
+            stopped and its request gets an error line
+        """
+        self.executor = executor
+        self.cache = cache
+        self.time_limit = time_limit
+        self.in_flight = {}
+        self.requests = 0
+        self.runs = 0
+        self.shared_runs = 0
+
+    def submit(self, task):
+        # Future of one run's row, shared with any identical run in flight
+        if task in self.in_flight:
+            self.shared_runs += 1
+            return self.in_flight[task]
+        future = asyncio.ensure_future(self.run_task(task))
+        self.in_flight[task] = future
+        future.add_done_callback(lambda _: self.in_flight.pop(task, None))
+        return future
+
+    async def run_task(self, task):
+        if self.cache is not None:
+            cached = self.cache.get_many([task])
+            if cached:
+                return cached[0]
+        self.runs += 1
+        loop = asyncio.get_running_loop()
+        row = await loop.run_in_executor(
+            self.executor, simulate_with_limit, task, self.time_limit
+        )
+        if self.cache is not None:
+            self.cache.put(task, row)
+        return row
+
+    async def simulate(self, tasks, confidence):
+        # Yield each run's row as it finishes, then the replication summary
+        rows = []
+        for future in asyncio.as_completed([self.submit(task) for task in tasks]):
+            row = await future
+            rows.append(row)
+            yield "replication", row
+        rows.sort(key=lambda row: row["Replication"])
+        yield "summary", replication_stats(rows, confidence)
+
+    def health(self):
+        return {
+            "status": "ok",
+            "model_version": MODEL_VERSION,
+            "requests": self.requests,
+            "runs": self.runs,
+            "shared_runs": self.shared_runs,
+            "in_flight": len(self.in_flight),
+        }
+
+    async def handle(self, reader, writer):
+        # Serve one HTTP/1.1 request per connection
+        try:
+            request_line = await reader.readline()
+            method, path, _ = request_line.decode("latin-1").split(" ", 2)
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+            length = int(headers.get("content-length", 0))
+            if length > MAX_BODY_BYTES:
+                await self.respond(writer, 413, {"error": "Request too large"})
+                return
+            body = await reader.readexactly(length)
+            if path == "/health" and method == "GET":
+                await self.respond(writer, 200, self.health())
+            elif path != "/simulate":
+                await self.respond(writer, 404, {"error": f"No route {path}"})
+            elif method != "POST":
+                await self.respond(writer, 405, {"error": "Use POST"})
+            else:
+                try:
+                    tasks, confidence = parse_request(json.loads(body or b"{}"))
+                except (ValueError, TypeError) as error:
+                    await self.respond(writer, 400, {"error": str(error)})
+                    return
+                self.requests += 1
+                await self.stream(writer, tasks, confidence)
+        except (ValueError, ConnectionError, asyncio.IncompleteReadError):
+            # Malformed request line or the client went away
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, writer, status, body):
+        data = json.dumps(body).encode()
+        writer.write(
+            f"HTTP/1.1 {status} {STATUS_TEXT[status]}\r\n"
+            f"Content-Type: application/json\r\n"
+            f"Content-Length: {len(data)}\r\n"
+            "Connection: close\r\n\r\n".encode() + data
+        )
+        await writer.drain()
+
+    async def stream(self, writer, tasks, confidence):
+        # Send the lines of a request as HTTP chunks as soon as each is ready
+        writer.write(
+            b"HTTP/1.1 200 OK\r\n"
+            b"Content-Type: application/x-ndjson\r\n"
+            b"Transfer-Encoding: chunked\r\n"
+            b"Connection: close\r\n\r\n"
+        )
+        try:
+            async for kind, row in self.simulate(tasks, confidence):
+                await self.write_chunk(writer, json_line(kind, row))
+        except (ConnectionError, asyncio.CancelledError):
+            raise
+        except Exception as error:
+            # A run failed, e.g. on a config value the model can't run with
+            logger.exception("Simulation request failed")
+            await self.write_chunk(writer, json_line("error", {"error": str(error)}))
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+    async def write_chunk(self, writer, data):
+        writer.write(b"%x\r\n%s\r\n" % (len(data), data))
+        await writer.drain()
+
+
+STATUS_TEXT = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    413: "Payload Too Large",
+}
+
+
+async def serve(host, port, workers, cache_path, time_limit=RUN_TIME_LIMIT):
+    cache = None
+    if cache_path is not None:
+        cache = ResultCache(cache_path, MODEL_VERSION, CACHE_MAX_BYTES)
+    workers = workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=workers, initializer=warm_worker) as executor:
+        # Start and warm every worker before taking requests
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(
+            *(loop.run_in_executor(executor, abs, 0) for _ in range(workers))
+        )
+        service = SimulationService(executor, cache, time_limit)
+        server = await asyncio.start_server(service.handle, host, port)
+        logger.info(f"Serving on http://{host}:{port} with {workers} warm workers")
+        async with server:
+            await server.serve_forever()
+
+
+HOST = "127.0.0.1"  # Only listen locally
+PORT = 8765
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve VaccineClinic what-ifs")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument(
+        "--workers", type=int, default=None, help="worker processes, one per CPU"
+    )
+    parser.add_argument(
+        "--time-limit",
+        type=float,
+        default=RUN_TIME_LIMIT,
+        help="seconds a single run may take",
+    )
+    parser.add_argument(
+        "--no-cache", action="store_true", help=f"don't use {CACHE_PATH}"
+    )
+    args = parser.parse_args()
+    logger.remove()
+    logger.add(sys.stderr, format="{message}", level="INFO")
+    try:
+        asyncio.run(
+            serve(
+                args.host,
+                args.port,
+                args.workers,
+                None if args.no_cache else CACHE_PATH,
+                args.time_limit,
+            )
+        )
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,116 @@
+from math import factorial
+
+import numpy as np
+import pytest
+
+from arrivals import nhpp_arrival_times
+from main import (
+    ClinicConfig,
+    resume_scenario,
+    run_scenario,
+    snapshot_scenario,
+    summarize_clinic,
+    t_critical,
+)
+from online_stats import QuantileSketch, SampleStats, TimeWeightedStats
+from queueing import erlang_c
+
+# (confidence, degrees of freedom, two-sided critical value) from t tables
+T_TABLE = [
+    (0.95, 1, 12.706204736),
+    (0.99, 2, 9.924843201),
+    (0.95, 3, 3.182446305),
+    (0.99, 3, 5.840909310),
+    (0.999, 3, 12.923978638),
+    (0.90, 4, 2.131846786),
+    (0.95, 5, 2.570581836),
+    (0.999, 5, 6.868826626),
+    (0.99, 10, 3.169272673),
+    (0.95, 30, 2.042272456),
+    (0.95, 1000, 1.962339081),
+]
+
+
+@pytest.mark.parametrize("confidence, dof, expected", T_TABLE)
+def test_t_critical_matches_t_table(confidence, dof, expected):
+    assert t_critical(confidence, dof) == pytest.approx(expected, abs=1e-6)
+
+
+@pytest.mark.parametrize("p", [0.01, 0.1, 0.5, 0.9, 0.99])
+def test_sketch_quantiles_within_relative_accuracy(p):
+    # Time-ordered-looking data: a trend plus heavy-tailed noise, with zeros
+    generator = np.random.default_rng(3)
+    values = np.concatenate(
+        [
+            np.zeros(50),
+            np.linspace(1, 500, 5000) * generator.lognormal(0, 1, 5000),
+        ]
+    )
+    sketch = QuantileSketch(relative_accuracy=0.01)
+    for value in values:
+        sketch.add(value)
+    # The sketch answers with the observation of rank p * (count - 1)
+    exact = np.sort(values)[int(p * (len(values) - 1))]
+    assert abs(sketch.quantile(p) - exact) <= 0.01 * exact + 1e-12
+
+
+def test_sample_stats_match_numpy():
+    values = np.random.default_rng(5).exponential(60, 1000)
+    stats = SampleStats()
+    for value in values:
+        stats.add(value)
+    assert stats.mean == pytest.approx(values.mean())
+    assert stats.variance() == pytest.approx(values.var(ddof=1))
+    assert stats.max == values.max()
+
+
+def test_time_weighted_stats_on_step_series():
+    # Level 0 for 2 time units, 2 for 3 units, then 1 for 5 units
+    stats = TimeWeightedStats(start_time=0)
+    stats.update(2, 2)
+    stats.update(5, 1)
+    stats.close(10)
+    assert stats.mean() == pytest.approx((0 * 2 + 2 * 3 + 1 * 5) / 10)
+    assert stats.variance() == pytest.approx(
+        (2 * 1.1**2 + 3 * 0.9**2 + 5 * 0.1**2) / 10
+    )
+    assert stats.max == 2
+    assert stats.quantile(0.1) == 0
+    assert stats.quantile(0.5) == 1
+    assert stats.quantile(0.9) == 2
+
+
+@pytest.mark.parametrize("time", [1, 600, 3000, 10_000, 14_400, 30_000, 43_000])
+def test_resume_from_snapshot_reproduces_full_run(time):
+    config = ClinicConfig(num_receptionists=2, num_nurses=5, seed=7)
+    full = run_scenario(config)
+    resumed = resume_scenario(snapshot_scenario(config, time))
+    assert summarize_clinic(resumed) == summarize_clinic(full)
+    assert resumed.patient_info_df.equals(full.patient_info_df)
+    assert resumed.event_log_df.equals(full.event_log_df)
+
+
+@pytest.mark.parametrize("servers, offered_load", [(1, 0.5), (2, 1.0), (10, 8.0)])
+def test_erlang_c_matches_closed_form(servers, offered_load):
+    rho = offered_load / servers
+    waiting = offered_load**servers / factorial(servers) / (1 - rho)
+    expected = waiting / (
+        sum(offered_load**k / factorial(k) for k in range(servers)) + waiting
+    )
+    assert erlang_c(servers, offered_load) == pytest.approx(expected)
+    # An overloaded queue always waits
+    assert erlang_c(servers, servers + 1.0) == 1.0
+
+
+def test_nhpp_arrivals_follow_the_profile():
+    # No walk-ins for the first hour, then 60 an hour, then 240 an hour
+    starts = np.array([0.0, 3600.0, 7200.0])
+    rates = np.array([0.0, 60.0, 240.0]) / 3600
+    generator = np.random.default_rng(11)
+    days = [nhpp_arrival_times(generator, starts, rates, 3 * 3600) for _ in range(400)]
+    times = np.concatenate(days)
+    assert all((np.diff(day) >= 0).all() for day in days)
+    assert not (times < 3600).any()
+    # Mean counts per hour, within about four standard errors
+    assert ((times < 7200).sum() / 400) == pytest.approx(60, abs=1.6)
+    assert ((times >= 7200).sum() / 400) == pytest.approx(240, abs=3.2)